@@ -7,12 +7,42 @@ Created on Thu Nov 14 15:48:43 2024
 @author: Maurice HT Ling
 """
 
+import dbm
+import os
+import pickle
 import shelve
+import sqlite3
+import heapq
+from bisect import bisect_left, bisect_right, insort
 import random
+import re
+import struct
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from operator import itemgetter
+from itertools import chain, islice
+from collections import OrderedDict
+from collections.abc import MutableMapping
 from faker import Faker
 
+try:
+    import fcntl
+except ImportError:
+    # Windows locks files through msvcrt instead
+    fcntl = None
+    import msvcrt
+
 fake = Faker()
 
+LAYOUT_KEY = "__layout__"
+GENERATION_KEY = "__generation__"
+TABLE_LAYOUT = "table"
+ROW_LAYOUT = "row"
+
 
 def table_keys():
     return {
@@ -36,67 +66,1299 @@ def table_foreign_keys():
     }
 
 
-def init_hypergraph():
+def table_indexes():
+    """
+    The attributes each table keeps a secondary hash index on
+    select uses these for "=" conditionals instead of scanning the table
+    """
+    return {
+        "customer": ("username",),
+        "supplier": ("supplier_name",),
+        "product": ("product_name",),
+    }
+
+
+def table_text_indexes():
+    """
+    The text attributes each table keeps an inverted index of its words on, see TextIndex
+    """
+    return {"order_content": ("feedback",)}
+
+
+def table_range_indexes():
+    """
+    The numeric attributes each table keeps an ordered index on, see RangeIndex
+    select uses these for "<" and ">" conditionals instead of scanning the table
+    """
+    return {
+        "product": ("stock", "price"),
+        "cart_item": ("quantity",),
+        "order_content": ("quantity",),
+    }
+
+
+def foreign_key_indexes():
+    """
+    The attributes each table keeps a reverse foreign key index on, derived from table_foreign_keys
+    Each index maps a parent row's primary key to the keys of the child rows referencing it
+    A foreign key that is the child's whole primary key (payment's orderid) needs no index,
+    and one that leads a composite primary key (cart_item's userid) uses a PrefixIndex instead
+    """
+    tables_and_keys = table_keys()
+    ret = {}
+    for child in table_foreign_keys():
+        child_key = tables_and_keys[child]
+        for parent in get_foreign_key_list(child):
+            attribute = tables_and_keys[parent]
+            if attribute == child_key:
+                continue
+            if type(child_key) is tuple and attribute == child_key[0]:
+                continue
+            ret[child] = ret.get(child, ()) + (attribute,)
+    return ret
+
+
+def materialized_views():
+    """
+    The views kept up to date by insert, update and delete, see MaterializedView
+    """
+    return {"in_stock_products": InStockProducts, "order_totals": OrderTotals}
+
+
+def table_sequences():
+    """
+    The tables whose integer primary keys are handed out by a persisted sequence
+    """
+    return ("customer", "supplier", "product", "order")
+
+
+def indexed_attributes(tablename):
+    """
+    All attributes of a table with a hash index, declared or foreign key
+    """
+    return table_indexes().get(tablename, ()) + foreign_key_indexes().get(tablename, ())
+
+
+class SqliteDbm(MutableMapping):
+    """
+    A dbm-style mapping of bytes keys to bytes values, kept in one table of a sqlite3 file
+    dbm.dumb, the dbm module shelve falls back to, rewrites its whole key file on every sync,
+    so with a key per row or per index value every commit costs I/O in the size of the store.
+    sqlite updates the keys written since the last sync in place.
+    Writes are grouped into one transaction, which sync commits
+        @param path : the sqlite3 file
+        @type path : string
+        @param flag : "r" to open the file read-only, "c" to create it if it does not exist
+        @type flag : string
+        @default flag : "c"
+    """
+
+    def __init__(self, path, flag="c"):
+        self.connection = sqlite3.connect(path)
+        if flag == "r":
+            self.connection.execute("PRAGMA query_only = ON")
+        else:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS shelf "
+                "(key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID"
+            )
+            self.connection.commit()
+
+    def __getitem__(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM shelf WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __setitem__(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO shelf (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def __delitem__(self, key):
+        cursor = self.connection.execute("DELETE FROM shelf WHERE key = ?", (key,))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM shelf WHERE key = ?", (key,)
+            ).fetchone()
+            is not None
+        )
+
+    def __iter__(self):
+        keys = self.connection.execute("SELECT key FROM shelf").fetchall()
+        return iter([row[0] for row in keys])
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM shelf").fetchone()[0]
+
+    def sync(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def sqlite_path(name):
+    """
+    The file of a store kept in sqlite3, see SqliteDbm
+    """
+    return name + ".sqlite"
+
+
+def open_hypergraph(name="hypergraph", flag="c"):
+    """
+    Opens the shelve of a store
+    Stores created by init_hypergraph are kept in sqlite3, stores written before that
+    with shelve.open's own dbm module are still opened with it
+        @param name : the name of the store
+        @type name : string
+        @default name : "hypergraph"
+        @param flag : "r" to open it read-only, "c" to open it for writing
+        @type flag : string
+        @default flag : "c"
+        @return : a shelve
+    """
+    path = sqlite_path(name)
+    if os.path.exists(path):
+        return shelve.Shelf(SqliteDbm(path, flag))
+    return shelve.open(name, flag)
+
+
+def init_hypergraph(name="hypergraph", layout=ROW_LAYOUT):
     """
-    Creates a blank shelve file with the proper table names
-    If there was a shelve file named name before, it gets cleared
-        @param name : the name of the shelve file to opem
+    Creates a blank store with the proper table names, kept in sqlite3 (see open_hypergraph)
+    If there was a store named name before, it gets cleared
+        @param name : the name of the store
         @type name : string
         @default name : "hypergraph"
-        @param tables_and_keys : the tables (and their primary keys) to initialize the hypergraph with
-        @type tables_and_keys : a dictionary of table names to primary key names
-        @default tables_and_keys : TABLE_KEYS defined at the beginning
+        @param layout : how the tables are stored in the shelve
+            ROW_LAYOUT stores every row under its own key, plus a chunked key directory per table
+            TABLE_LAYOUT stores every table as one pickled dictionary
+        @type layout : string
+        @default layout : ROW_LAYOUT
     """
-    hypergraph = shelve.open("hypergraph")
-    hypergraph.clear()
+    path = sqlite_path(name)
+    if os.path.exists(path):
+        os.remove(path)
+    if dbm.whichdb(name):
+        # a store written with shelve.open's own dbm module
+        shelve.open(name, "n").close()
+    hypergraph = shelve.Shelf(SqliteDbm(path))
+    hypergraph[LAYOUT_KEY] = layout
     tables_and_keys = table_keys()
     for table_name in tables_and_keys:
-        hypergraph[table_name] = {}
+        if layout == ROW_LAYOUT:
+            hypergraph[directory_key(table_name)] = {}
+        else:
+            hypergraph[table_name] = {}
+    # the indexes of an empty table are complete without any entries
+    for table_name in tables_and_keys:
+        for attribute in indexed_attributes(table_name):
+            hypergraph[HashIndex.marker_key(table_name, attribute)] = True
+        for attribute in table_text_indexes().get(table_name, ()):
+            hypergraph[TextIndex.marker_key(table_name, attribute)] = True
+        for attribute in table_range_indexes().get(table_name, ()):
+            key = RangeIndex.directory_key(table_name, attribute)
+            hypergraph[key] = {"bounds": [], "ids": [], "next_id": 0}
+    for table_name in table_sequences():
+        hypergraph[sequence_key(table_name)] = 1
     hypergraph.sync()
     hypergraph.close()
 
 
+def hypergraph_layout(hypergraph):
+    """
+    Returns the storage layout of the shelve file
+    Shelve files written before the row layout existed have no layout key and use TABLE_LAYOUT
+        @param hypergraph : the hypergraph shelve file's dictionary
+        @type hypergraph : a shelve
+        @return : ROW_LAYOUT or TABLE_LAYOUT
+    """
+    return hypergraph.get(LAYOUT_KEY, TABLE_LAYOUT)
+
+
+def row_key(tablename, primary_key):
+    """
+    Encodes the shelve key a row is stored under in the row layout
+    Tuple keys such as cart_item's (userid, productid) are joined with commas
+        @param tablename : the table the row is in
+        @type tablename : string
+        @param primary_key : the primary key of the row
+        @type primary_key : a number or a tuple of two numbers
+        @return : a string like "product:17" or "cart_item:3,5"
+    """
+    if type(primary_key) is tuple:
+        primary_key = ",".join(str(k) for k in primary_key)
+    return f"{tablename}:{primary_key}"
+
+
+def directory_key(tablename):
+    """
+    The shelve key of a table's key directory in the row layout
+    It holds the number of keys in each chunk of the directory, the chunks have their own keys
+    """
+    return f"{tablename}:__keys__"
+
+
+# primary keys per chunk of a key directory
+DIRECTORY_CHUNK_SIZE = 1024
+
+
+def chunk_key(tablename, chunk):
+    """
+    The shelve key of one chunk of a table's key directory in the row layout
+    """
+    return f"{tablename}:__keys__:{chunk}"
+
+
+def directory_chunk(primary_key):
+    """
+    The chunk of the key directory a primary key belongs to
+    Keys are grouped by value, tuple keys by their leading component, so the keys handed out
+    by a sequence fill one chunk after the other
+    """
+    if type(primary_key) is tuple:
+        primary_key = primary_key[0]
+    if isinstance(primary_key, int):
+        return primary_key // DIRECTORY_CHUNK_SIZE
+    return 0
+
+
+class RowTable(MutableMapping):
+    """
+    A table stored one row per shelve key
+    The key directory is split into chunks of keys stored under their own shelve keys, so a write
+    only rewrites the chunk of the keys it inserted or deleted. When the table is created only
+    the size of each chunk is read, chunks are read the first time a key in them is looked up,
+    and rows are only unpickled when accessed
+    flush() writes back the rows that insert, update and delete marked as dirty
+        @param hypergraph : the hypergraph shelve file's dictionary
+        @type hypergraph : a shelve
+        @param tablename : the table to read
+        @type tablename : string
+    """
+
+    def __init__(self, hypergraph, tablename):
+        self.hypergraph = hypergraph
+        self.name = tablename
+        self.rows = {}
+        self.indexes = {}
+        self.text_indexes = {}
+        self.range_indexes = {}
+        # chunk -> number of keys in it, and chunk -> its keys for the chunks read so far
+        self.chunk_sizes = hypergraph[directory_key(tablename)]
+        self.chunks = {}
+        self.changed_chunks = set()
+        self.sizes_changed = False
+        if type(self.chunk_sizes) is list:
+            # shelve files written before the directory was split into chunks
+            keys = self.chunk_sizes
+            self.chunk_sizes = {}
+            for pk in keys:
+                self.chunks.setdefault(directory_chunk(pk), {})[pk] = None
+            for chunk, chunk_keys in self.chunks.items():
+                self.chunk_sizes[chunk] = len(chunk_keys)
+            self.changed_chunks = set(self.chunks)
+            self.sizes_changed = True
+
+    def chunk(self, chunk):
+        """
+        The keys in a chunk of the directory, read from the shelve the first time
+        """
+        try:
+            return self.chunks[chunk]
+        except KeyError:
+            pass
+        keys = {}
+        if chunk in self.chunk_sizes:
+            keys = dict.fromkeys(self.hypergraph[chunk_key(self.name, chunk)])
+        self.chunks[chunk] = keys
+        return keys
+
+    def __getitem__(self, primary_key):
+        try:
+            return self.rows[primary_key]
+        except KeyError:
+            if primary_key not in self:
+                raise
+        row = self.hypergraph[row_key(self.name, primary_key)]
+        self.rows[primary_key] = row
+        return row
+
+    def __setitem__(self, primary_key, row):
+        chunk = directory_chunk(primary_key)
+        keys = self.chunk(chunk)
+        if primary_key not in keys:
+            keys[primary_key] = None
+            self.chunk_sizes[chunk] = len(keys)
+            self.changed_chunks.add(chunk)
+            self.sizes_changed = True
+        self.rows[primary_key] = row
+
+    def __delitem__(self, primary_key):
+        chunk = directory_chunk(primary_key)
+        keys = self.chunk(chunk)
+        del keys[primary_key]
+        if keys:
+            self.chunk_sizes[chunk] = len(keys)
+        else:
+            del self.chunk_sizes[chunk]
+        self.changed_chunks.add(chunk)
+        self.sizes_changed = True
+        self.rows.pop(primary_key, None)
+
+    def __contains__(self, primary_key):
+        return primary_key in self.chunk(directory_chunk(primary_key))
+
+    def __iter__(self):
+        for chunk in sorted(self.chunk_sizes):
+            yield from self.chunk(chunk)
+
+    def __len__(self):
+        return sum(self.chunk_sizes.values())
+
+    def flush(self, primary_keys=None):
+        """
+        Writes rows back to the shelve
+        Rows that are no longer in the table are overwritten with None rather than deleted,
+        as every deletion from a dbm.dumb shelve rewrites its whole key file
+        Only the chunks of the key directory that rows were inserted into or deleted from
+        are rewritten, an emptied chunk is left behind as an empty list
+            @param primary_keys : the rows to write
+            @type primary_keys : an iterable of primary keys
+            @default primary_keys : None, every row that has been read or written
+        """
+        if primary_keys is None:
+            primary_keys = list(self.rows)
+        for pk in primary_keys:
+            if pk in self:
+                self.hypergraph[row_key(self.name, pk)] = self[pk]
+            else:
+                self.hypergraph[row_key(self.name, pk)] = None
+        for chunk in self.changed_chunks:
+            self.hypergraph[chunk_key(self.name, chunk)] = list(self.chunk(chunk))
+        if self.sizes_changed:
+            self.hypergraph[directory_key(self.name)] = self.chunk_sizes
+        self.changed_chunks = set()
+        self.sizes_changed = False
+
+
+class Table(dict):
+    """
+    A table of the table layout, read from the shelve as one dictionary
+    It only differs from a dict by carrying its name and its indexes
+        @param tablename : the table's name
+        @type tablename : string
+        @param rows : the rows of the table
+        @type rows : a 2-level dictionary
+    """
+
+    def __init__(self, tablename, rows):
+        super().__init__(rows)
+        self.name = tablename
+        self.indexes = {}
+        self.text_indexes = {}
+        self.range_indexes = {}
+
+
+class HashIndex:
+    """
+    A secondary index from the values of one attribute to the primary keys of the rows holding them
+    Values are compared as strings, the same way select's "=" conditional compares them
+    The keys for each value are stored under their own shelve key and only read when looked up,
+    so maintaining the index costs O(1) I/O per changed row
+        @param hypergraph : the hypergraph shelve file's dictionary
+        @type hypergraph : a shelve
+        @param tablename : the indexed table
+        @type tablename : string
+        @param attribute : the indexed attribute
+        @type attribute : string
+    """
+
+    # the start of the index's shelve keys, which tells the kinds of index apart
+    kind = "__index__"
+
+    def __init__(self, hypergraph, tablename, attribute):
+        self.hypergraph = hypergraph
+        self.tablename = tablename
+        self.attribute = attribute
+        self.prefix = f"{self.kind}:{tablename}.{attribute}="
+        self.entries = {}
+        self.complete = False
+        self.dirty = set()
+        self.marker_dirty = False
+
+    @classmethod
+    def marker_key(cls, tablename, attribute):
+        """
+        The shelve key recording that an index has been built and persisted
+        """
+        return f"{cls.kind}:{tablename}.{attribute}"
+
+    def persisted(self):
+        return self.marker_key(self.tablename, self.attribute) in self.hypergraph
+
+    def index_keys(self, value):
+        """
+        The keys of the index a row holding value is filed under
+        """
+        return () if value is None else (str(value),)
+
+    def build(self, table, persist=True):
+        """
+        Fills the index by scanning every row of table
+            @param table : the indexed table
+            @type table : a 2-level dictionary
+            @param persist : whether the next flush writes the whole index to the shelve
+            @type persist : boolean
+        """
+        self.entries = {}
+        for pk in table:
+            for key in self.index_keys(table[pk].get(self.attribute)):
+                self.entries.setdefault(key, set()).add(pk)
+        self.complete = True
+        if persist:
+            self.dirty = set(self.entries)
+            self.marker_dirty = True
+        else:
+            # values changed since the last flush still have to be written, emptied ones too
+            for key in self.dirty:
+                self.entries.setdefault(key, set())
+
+    def lookup(self, value):
+        """
+        Returns the primary keys of the rows whose attribute equals value
+        The returned set belongs to the index and must not be modified
+        """
+        return self.posting(str(value))
+
+    def posting(self, key):
+        """
+        Returns the primary keys filed under a key of the index, reading them the first time
+        """
+        try:
+            return self.entries[key]
+        except KeyError:
+            pass
+        keys = set()
+        if not self.complete:
+            keys = self.hypergraph.get(self.prefix + key, keys)
+        self.entries[key] = keys
+        return keys
+
+    def add(self, value, primary_key):
+        for key in self.index_keys(value):
+            self.posting(key).add(primary_key)
+            self.dirty.add(key)
+
+    def remove(self, value, primary_key):
+        for key in self.index_keys(value):
+            self.posting(key).discard(primary_key)
+            self.dirty.add(key)
+
+    def flush(self):
+        """
+        Writes the entries changed since the last flush to the shelve
+        A value no row holds any more is written as an empty set rather than deleted,
+        as every deletion from a dbm.dumb shelve rewrites its whole key file
+        """
+        for key in self.dirty:
+            self.hypergraph[self.prefix + key] = self.entries[key]
+        if self.marker_dirty:
+            self.hypergraph[self.marker_key(self.tablename, self.attribute)] = True
+        self.dirty = set()
+        self.marker_dirty = False
+
+
+class PrefixIndex:
+    """
+    An index from the leading component of a composite primary key to the keys starting with it,
+    such as cart_item's userid or order_content's orderid
+    It is built from the table's keys alone the first time it is looked up, so no row is read
+    and nothing is persisted. It has the same interface as HashIndex.
+        @param table : the table with a composite primary key
+        @type table : a Table or a RowTable
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.entries = None
+
+    @property
+    def complete(self):
+        return self.entries is not None
+
+    def build(self, table=None, persist=False):
+        self.entries = {}
+        for pk in self.table:
+            self.entries.setdefault(str(pk[0]), {})[pk] = None
+
+    def lookup(self, value):
+        """
+        Returns the primary keys whose leading component equals value, in insertion order
+        """
+        if self.entries is None:
+            self.build()
+        return self.entries.get(str(value), {}).keys()
+
+    def add(self, value, primary_key):
+        # before the first lookup the table's keys are the index
+        if self.entries is not None and value is not None:
+            self.entries.setdefault(str(primary_key[0]), {})[primary_key] = None
+
+    def remove(self, value, primary_key):
+        if self.entries is not None and value is not None:
+            self.entries.get(str(primary_key[0]), {}).pop(primary_key, None)
+
+    def flush(self):
+        pass
+
+
+def tokenize(text):
+    """
+    The terms of a text, lowercased words
+    """
+    if not isinstance(text, str):
+        return set()
+    return set(re.findall(r"\w+", text.lower()))
+
+
+class TextIndex(HashIndex):
+    """
+    An inverted index from the terms of a text attribute to the keys of the rows containing them,
+    such as order_content's feedback
+    It is a HashIndex that files a row under every term of its text instead of under its value,
+    so its postings are persisted the same way, one shelve key per term read when searched
+    """
+
+    kind = "__text__"
+
+    def index_keys(self, value):
+        return tokenize(value)
+
+    def search(self, terms, match_all=True):
+        """
+        Returns the primary keys of the rows containing all of terms, or any of them
+            @param terms : the words to look for
+            @type terms : string
+            @param match_all : True for rows with every term (AND), False for any term (OR)
+            @type match_all : boolean
+            @return : a set of primary keys
+        """
+        postings = [self.posting(term) for term in tokenize(terms)]
+        if not postings:
+            return set()
+        if not match_all:
+            return set().union(*postings)
+        postings.sort(key=len)
+        keys = set(postings[0])
+        for posting in postings[1:]:
+            keys.intersection_update(posting)
+        return keys
+
+
+def is_number(value):
+    """
+    Whether a value can be kept in a RangeIndex, NaN is not ordered
+    """
+    return isinstance(value, (int, float)) and value == value
+
+
+# entries per chunk of a RangeIndex, a chunk holding twice as many is split in two
+RANGE_CHUNK_SIZE = 512
+
+
+class RangeIndex:
+    """
+    An ordered index of a numeric attribute, such as product's stock and price
+    The index is a sorted list of (value, primary key) entries searched with bisect, so a range
+    of k rows is found in O(log n + k) and an entry is found for removal in O(log n) however
+    many rows share its value. Rows whose value is not a number are left out, no number
+    compares to them anyway.
+    The list is split into chunks stored under their own shelve keys, and a directory of the
+    first entry of each chunk, so a change only rewrites the chunk it falls in and a range
+    only reads the chunks it spans. Shelve files written before the index was persisted get
+    it built from the table's rows when the table is read, and written by the next commit.
+        @param hypergraph : the hypergraph shelve file's dictionary
+        @type hypergraph : a shelve
+        @param table : the table holding the attribute
+        @type table : a Table or a RowTable
+        @param attribute : the numeric attribute
+        @type attribute : string
+    """
+
+    def __init__(self, hypergraph, table, attribute):
+        self.hypergraph = hypergraph
+        self.table = table
+        self.attribute = attribute
+        self.prefix = self.directory_key(table.name, attribute)
+        self.persisted = self.prefix in hypergraph
+        # the first entry of each chunk and the chunk's id, None until read or built
+        self.bounds = None
+        self.ids = None
+        self.next_id = 0
+        self.chunks = {}
+        self.dirty = set()
+        self.directory_dirty = False
+
+    @staticmethod
+    def directory_key(tablename, attribute):
+        """
+        The shelve key of the directory of an index's chunks, which have their own keys
+        """
+        return f"__range__:{tablename}.{attribute}"
+
+    def build(self):
+        entries = []
+        for pk in self.table:
+            value = self.table[pk].get(self.attribute)
+            if is_number(value):
+                entries.append((value, pk))
+        entries.sort()
+        self.bounds, self.ids, self.chunks = [], [], {}
+        for i in range(0, len(entries), RANGE_CHUNK_SIZE):
+            chunk = entries[i : i + RANGE_CHUNK_SIZE]
+            self.bounds.append(chunk[0])
+            self.ids.append(self.next_id)
+            self.chunks[self.next_id] = chunk
+            self.next_id += 1
+        self.dirty = set(self.chunks)
+        self.directory_dirty = True
+
+    def load(self):
+        """
+        Reads the directory of the index the first time it is needed
+        """
+        if self.bounds is not None:
+            return
+        directory = self.hypergraph[self.prefix]
+        self.bounds = directory["bounds"]
+        self.ids = directory["ids"]
+        self.next_id = directory["next_id"]
+
+    def chunk(self, i):
+        """
+        Returns the i-th chunk of the index, reading it the first time
+        """
+        chunk_id = self.ids[i]
+        try:
+            return self.chunks[chunk_id]
+        except KeyError:
+            pass
+        chunk = self.chunks[chunk_id] = self.hypergraph[f"{self.prefix}:{chunk_id}"]
+        return chunk
+
+    def find(self, entry):
+        """
+        Returns the position of the chunk an entry belongs in
+        """
+        return max(bisect_right(self.bounds, entry) - 1, 0)
+
+    def range(self, low=None, high=None, include_low=True, include_high=True):
+        """
+        Returns the primary keys of the rows whose value lies between low and high,
+        in the order of their values. A bound of None leaves that side of the range open.
+        """
+        self.load()
+        value = itemgetter(0)
+        first = 0
+        if low is not None:
+            # entries equal to low can start in the chunk before the first bound >= low
+            first = max(bisect_left(self.bounds, low, key=value) - 1, 0)
+        keys = []
+        for i in range(first, len(self.ids)):
+            chunk = self.chunk(i)
+            start, end = 0, len(chunk)
+            if low is not None:
+                search = bisect_left if include_low else bisect_right
+                start = search(chunk, low, key=value)
+            if high is not None:
+                search = bisect_right if include_high else bisect_left
+                end = search(chunk, high, key=value)
+            keys.extend(pk for _, pk in chunk[start:end])
+            if end < len(chunk):
+                break
+        return keys
+
+    def ordered(self, reverse=False):
+        """
+        Yields (value, primary key) for every numeric row, in the order of the values
+        """
+        self.load()
+        positions = range(len(self.ids))
+        for i in reversed(positions) if reverse else positions:
+            chunk = self.chunk(i)
+            yield from reversed(chunk) if reverse else chunk
+
+    def add(self, value, primary_key):
+        if not is_number(value):
+            return
+        self.load()
+        entry = (value, primary_key)
+        if not self.ids:
+            self.bounds.append(entry)
+            self.ids.append(self.next_id)
+            self.chunks[self.next_id] = []
+            self.next_id += 1
+            self.directory_dirty = True
+        i = self.find(entry)
+        chunk = self.chunk(i)
+        insort(chunk, entry)
+        self.dirty.add(self.ids[i])
+        if entry < self.bounds[i]:
+            self.bounds[i] = entry
+            self.directory_dirty = True
+        if len(chunk) >= 2 * RANGE_CHUNK_SIZE:
+            half = len(chunk) // 2
+            self.chunks[self.next_id] = chunk[half:]
+            del chunk[half:]
+            self.bounds.insert(i + 1, self.chunks[self.next_id][0])
+            self.ids.insert(i + 1, self.next_id)
+            self.dirty.add(self.next_id)
+            self.next_id += 1
+            self.directory_dirty = True
+
+    def remove(self, value, primary_key):
+        if not is_number(value):
+            return
+        self.load()
+        if not self.ids:
+            return
+        entry = (value, primary_key)
+        i = self.find(entry)
+        chunk = self.chunk(i)
+        j = bisect_left(chunk, entry)
+        if j == len(chunk) or chunk[j] != entry:
+            return
+        del chunk[j]
+        self.dirty.add(self.ids[i])
+        if not chunk:
+            # the emptied chunk is written as an empty list, like an emptied HashIndex value
+            del self.bounds[i]
+            del self.ids[i]
+            self.directory_dirty = True
+        elif j == 0:
+            self.bounds[i] = chunk[0]
+            self.directory_dirty = True
+
+    def flush(self):
+        """
+        Writes the chunks changed since the last flush, and the directory if it changed
+        """
+        for chunk_id in self.dirty:
+            self.hypergraph[f"{self.prefix}:{chunk_id}"] = self.chunks[chunk_id]
+        if self.directory_dirty:
+            self.hypergraph[self.prefix] = {
+                "bounds": self.bounds,
+                "ids": self.ids,
+                "next_id": self.next_id,
+            }
+            self.persisted = True
+        self.dirty = set()
+        self.directory_dirty = False
+
+
+def update_indexes(table, primary_key, old, new):
+    """
+    Keeps the indexes of a table current when one of its rows changes
+        @param table : the table the row is in
+        @type table : a Table or a RowTable, plain dictionaries have no indexes
+        @param primary_key : the key of the row
+        @type primary_key : a number or a tuple of two numbers
+        @param old : the row before the change, None if it was inserted
+        @type old : a 1-level dictionary
+        @param new : the row after the change, None if it was deleted
+        @type new : a 1-level dictionary
+    """
+    indexes = chain(
+        getattr(table, "indexes", {}).items(),
+        getattr(table, "text_indexes", {}).items(),
+        getattr(table, "range_indexes", {}).items(),
+    )
+    for attribute, index in indexes:
+        old_value = None if old is None else old.get(attribute)
+        new_value = None if new is None else new.get(attribute)
+        if old is not None and new is not None and old_value == new_value:
+            continue
+        index.remove(old_value, primary_key)
+        index.add(new_value, primary_key)
+
+
+class HypergraphDB(dict):
+    """
+    The tables of a hypergraph, keyed by table name
+    A table is only read from the shelve the first time it is accessed,
+    so iterating over a HypergraphDB only yields the tables loaded so far
+    insert, update and delete record the rows they touch in dirty
+    so commit_hypergraph only writes what changed
+        @param hypergraph : the hypergraph shelve file's dictionary
+        @type hypergraph : a shelve
+    """
+
+    def __init__(self, hypergraph):
+        super().__init__()
+        self.hypergraph = hypergraph
+        self.row_layout = hypergraph_layout(hypergraph) == ROW_LAYOUT
+        self.dirty = {}
+        # table name -> version of the committed data this db was loaded from (see table_versions)
+        self.versions = {}
+        # view name -> MaterializedView, for the views read so far
+        self.views = {}
+        # table name -> next primary key of its sequence, for the sequences read so far
+        self.sequences = {}
+        self.sequences_dirty = set()
+
+    def __missing__(self, tablename):
+        if tablename not in table_keys():
+            raise KeyError(tablename)
+        if self.row_layout:
+            table = RowTable(self.hypergraph, tablename)
+        else:
+            table = Table(tablename, self.hypergraph[tablename])
+        for attribute in indexed_attributes(tablename):
+            table.indexes[attribute] = HashIndex(self.hypergraph, tablename, attribute)
+        for attribute in table_text_indexes().get(tablename, ()):
+            table.text_indexes[attribute] = TextIndex(
+                self.hypergraph, tablename, attribute
+            )
+        for index in chain(table.indexes.values(), table.text_indexes.values()):
+            if not index.persisted():
+                # shelve files written before the index was declared
+                index.build(table)
+        key = table_keys()[tablename]
+        if type(key) is tuple:
+            table.indexes[key[0]] = PrefixIndex(table)
+        for attribute in table_range_indexes().get(tablename, ()):
+            table.range_indexes[attribute] = RangeIndex(
+                self.hypergraph, table, attribute
+            )
+        for index in table.range_indexes.values():
+            if not index.persisted:
+                # shelve files written before the index was persisted
+                index.build()
+        self[tablename] = table
+        return table
+
+
+def sequence_key(tablename):
+    """
+    The shelve key holding the next primary key of a table's sequence
+    """
+    return f"__sequence__:{tablename}"
+
+
+def load_sequence(db, tablename):
+    """
+    Returns the next primary key of a table's sequence, reading it from the shelve if needed
+    Shelve files written before sequences existed start the sequence after the largest key,
+    which costs one pass over the keys and is persisted with the next commit
+    """
+    try:
+        return db.sequences[tablename]
+    except KeyError:
+        pass
+    start = db.hypergraph.get(sequence_key(tablename))
+    if start is None:
+        table = db[tablename]
+        start = max(table.keys()) + 1 if len(table) > 0 else 1
+        db.sequences_dirty.add(tablename)
+    db.sequences[tablename] = start
+    return start
+
+
+def reserve_keys(db, tablename, count=1):
+    """
+    Reserves count consecutive primary keys from the table's sequence in O(1)
+    Keys are never handed out twice, even after the rows holding them are deleted
+    The reservation becomes durable with the next commit
+    Plain dictionaries without sequences fall back to the largest key plus one
+        @param db: the hypergraph in its entirety
+        @type db: a HypergraphDB
+        @param tablename: a table listed in table_sequences
+        @type tablename: string
+        @param count: how many keys to reserve
+        @type count: integer
+        @default count: 1
+        @return: the first reserved key, the others follow it
+    """
+    if getattr(db, "sequences", None) is None:
+        table = db[tablename]
+        return max(table.keys()) + 1 if len(table) > 0 else 1
+    start = load_sequence(db, tablename)
+    db.sequences[tablename] = start + count
+    db.sequences_dirty.add(tablename)
+    return start
+
+
+def advance_sequence(db, tablename, primary_key):
+    """
+    Moves a table's sequence past primary_key
+    Keeps the sequence correct when rows are stored with keys it did not hand out,
+    such as rows replayed from the write-ahead log after a crash
+    """
+    if getattr(db, "sequences", None) is None or tablename not in table_sequences():
+        return
+    if primary_key >= load_sequence(db, tablename):
+        db.sequences[tablename] = primary_key + 1
+        db.sequences_dirty.add(tablename)
+
+
+def mark_dirty(db, tablename, primary_key):
+    """
+    Records that db[tablename][primary_key] was inserted, updated or deleted
+    Does nothing for plain dictionaries that do not track changes
+        @param db: the hypergraph in its entirety
+        @type db: a HypergraphDB
+        @param tablename: the table that changed
+        @type tablename: a string which is a key in db
+        @param primary_key: the key of the row that changed
+        @type primary_key: a number or a tuple of two numbers
+    """
+    dirty = getattr(db, "dirty", None)
+    if dirty is not None:
+        dirty.setdefault(tablename, set()).add(primary_key)
+
+
+def put_row(db, tablename, primary_key, row):
+    """
+    Stores row at db[tablename][primary_key] without any foreign key checks
+    Keeps the table's indexes and the materialized views current and marks the row dirty
+    """
+    table = db[tablename]
+    old = table.get(primary_key)
+    table[primary_key] = row
+    update_indexes(table, primary_key, old, row)
+    if old is None:
+        advance_sequence(db, tablename, primary_key)
+    mark_dirty(db, tablename, primary_key)
+    update_views(db, tablename, primary_key, old, row)
+
+
+def remove_row(db, tablename, primary_key):
+    """
+    Removes db[tablename][primary_key] without cascading
+    Keeps the table's indexes and the materialized views current and marks the row dirty
+        @return : the removed row
+    """
+    table = db[tablename]
+    old = table.pop(primary_key)
+    update_indexes(table, primary_key, old, None)
+    mark_dirty(db, tablename, primary_key)
+    update_views(db, tablename, primary_key, old, None)
+    return old
+
+
 def load_hypergraph(hypergraph):
     """
     Loads in a dictionary from the provided shelve file dictionary
     Only works using the defaults established in TABLE_KEYS
+    Tables are read lazily, the first time they are accessed
+    In the row layout each table is a RowTable, which only unpickles the rows that are accessed
         @param hypergraph : the complete database
         @type hypergraph : a shelve
         @return : a 3-level dictionary representing the hypergraph
     """
-    customer = hypergraph["customer"]
-    cart_item = hypergraph["cart_item"]
-    supplier = hypergraph["supplier"]
-    product = hypergraph["product"]
-    order = hypergraph["order"]
-    order_content = hypergraph["order_content"]
-    payment = hypergraph["payment"]
-    db = {
-        "customer": customer,
-        "cart_item": cart_item,
-        "supplier": supplier,
-        "product": product,
-        "order": order,
-        "order_content": order_content,
-        "payment": payment,
-    }
-    return db
+    return HypergraphDB(hypergraph)
+
+
+def materialize_hypergraph(db):
+    """
+    Reads every row of every table into memory
+    Afterwards db no longer needs its shelve and can be used once the shelve is closed
+        @param db : the hypergraph in its entirety
+        @type db : a HypergraphDB
+    """
+    for t in table_keys():
+        table = db[t]
+        if isinstance(table, RowTable):
+            for pk in table:
+                table[pk]
+        for index in chain(table.indexes.values(), table.text_indexes.values()):
+            if not index.complete:
+                index.build(table, persist=False)
+        for index in table.range_indexes.values():
+            index.load()
+            for i in range(len(index.ids)):
+                index.chunk(i)
+    for name, view_class in materialized_views().items():
+        if view_class.persisted:
+            view = materialized_view(db, name)
+            for key in view.keys(db):
+                view.row(db, key)
 
 
 def commit_hypergraph(hypergraph, db):
     """
     Updates the hypergraph shelve file to match the contents of DB
+    Every commit increases the shelve's generation number, which the read cache checks
+    Only the tables marked dirty by insert, update and delete are written,
+    and in the row layout only their dirty rows
+    A plain dictionary without dirty marks is compared to the tables in the shelve row by row,
+    in either layout, and the rows that differ are written with their indexes kept current
         @param hypergraph : the hypergraph shelve file's dictionary
         @type hypergraph : a shelve
         @param db : the updated database
-        @type db : a 3-level dictionary
+        @type db : a HypergraphDB or a 3-level dictionary
     """
-    tables_and_keys = table_keys()
-    for t in tables_and_keys:
-        hypergraph[t] = db[t]
+    dirty = getattr(db, "dirty", None)
+    if dirty is None:
+        db = apply_tables(load_hypergraph(hypergraph), db)
+        dirty = db.dirty
+    row_layout = hypergraph_layout(hypergraph) == ROW_LAYOUT
+    for t, primary_keys in dirty.items():
+        if row_layout:
+            db[t].flush(primary_keys)
+        else:
+            hypergraph[t] = dict(db[t])
+    dirty.clear()
+    for table in db.values():
+        indexes = chain(
+            getattr(table, "indexes", {}).values(),
+            getattr(table, "text_indexes", {}).values(),
+            getattr(table, "range_indexes", {}).values(),
+        )
+        for index in indexes:
+            index.flush()
+    for view in getattr(db, "views", {}).values():
+        if view.persisted:
+            view.flush(db)
+    for t in getattr(db, "sequences_dirty", ()):
+        hypergraph[sequence_key(t)] = db.sequences[t]
+    if getattr(db, "sequences_dirty", None):
+        db.sequences_dirty.clear()
+    hypergraph[GENERATION_KEY] = hypergraph.get(GENERATION_KEY, 0) + 1
     hypergraph.sync()
 
 
+def apply_tables(db, tables):
+    """
+    Makes the tables of db match plain dictionaries, changing only the rows that differ
+        @param db : the hypergraph loaded from the shelve
+        @type db : a HypergraphDB
+        @param tables : the new contents of some of the tables
+        @type tables : a 3-level dictionary
+        @return : db, with the changed rows marked dirty
+    """
+    for t, rows in tables.items():
+        table = db[t]
+        for pk in [pk for pk in table if pk not in rows]:
+            remove_row(db, t, pk)
+        for pk, row in rows.items():
+            if table.get(pk) != row:
+                put_row(db, t, pk, row)
+    return db
+
+
+"""write-ahead log"""
+
+
+class WriteAheadLog:
+    """
+    An append-only log of committed row changes kept next to a shelve file
+    Every commit appends one record holding all of its (tablename, primary_key, row) changes,
+    where row is None for a deleted row. Records are framed by their length and a CRC32,
+    so a record torn by a crash is ignored on replay, and cut off when the log is opened
+    so the records appended after it are not hidden behind it.
+    fsync is batched: commits within group_commit_window seconds of the last fsync
+    are only written to the operating system, and a timer fsyncs them once the window has
+    passed, so every commit reaches the disk at most group_commit_window seconds after it
+        @param path : the log file
+        @type path : string
+        @param group_commit_window : seconds an fsync may be delayed to batch commits, 0 syncs every commit
+        @type group_commit_window : number
+        @default group_commit_window : 0
+    """
+
+    HEADER = struct.Struct("<II")
+
+    def __init__(self, path, group_commit_window=0):
+        self.path = path
+        self.group_commit_window = group_commit_window
+        self.file = open(path, "ab")
+        end = wal_length(path)
+        if self.file.tell() > end:
+            self.file.truncate(end)
+            os.fsync(self.file.fileno())
+        self.records = 0
+        self.unsynced = False
+        self.last_sync = time.monotonic()
+        # the timer's fsync runs on another thread
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def append(self, changes):
+        """
+        Appends one commit's changes to the log
+            @param changes : the changed rows
+            @type changes : a list of (tablename, primary_key, row) tuples
+        """
+        data = pickle.dumps(changes, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.file.write(self.HEADER.pack(len(data), zlib.crc32(data)) + data)
+            self.file.flush()
+            self.records += 1
+            self.unsynced = True
+            wait = self.last_sync + self.group_commit_window - time.monotonic()
+            if wait <= 0:
+                self._sync()
+            elif self.timer is None:
+                self.timer = threading.Timer(wait, self.sync)
+                self.timer.start()
+
+    def sync(self):
+        """
+        Forces every appended record to disk
+        """
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = False
+        self.last_sync = time.monotonic()
+
+    def truncate(self):
+        """
+        Empties the log once its records have been checkpointed into the shelve
+        """
+        with self.lock:
+            self.file.truncate(0)
+            os.fsync(self.file.fileno())
+            self.records = 0
+            self.unsynced = False
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+class FileLock:
+    """
+    An exclusive lock on a file, held until release() is called or the process exits
+    Only the session holding the lock of a write-ahead log may write its records into the shelve
+    or empty it. The lock is taken without waiting, and another session of the same process
+    holding it counts as well.
+        @param path : the lock file, created if it does not exist
+        @type path : string
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    @property
+    def held(self):
+        return self.file is not None
+
+    def acquire(self):
+        """
+        Takes the lock, returns False if another session holds it
+        """
+        if self.file is not None:
+            return True
+        lock = open(self.path, "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock.close()
+            return False
+        self.file = lock
+        return True
+
+    def release(self):
+        if self.file is None:
+            return
+        if fcntl is None:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+        self.file = None
+
+
+def scan_wal(path):
+    """
+    Reads the complete records of a write-ahead log without unpickling them
+    Reading stops at the first torn or corrupt record
+        @param path : the log file
+        @type path : string
+        @return : a generator of (offset after the record, pickled changes)
+    """
+    try:
+        log = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with log:
+        end = 0
+        while True:
+            header = log.read(WriteAheadLog.HEADER.size)
+            if len(header) < WriteAheadLog.HEADER.size:
+                return
+            size, crc = WriteAheadLog.HEADER.unpack(header)
+            data = log.read(size)
+            if len(data) < size or zlib.crc32(data) != crc:
+                return
+            end += WriteAheadLog.HEADER.size + size
+            yield end, data
+
+
+def read_wal(path):
+    """
+    Reads the complete records of a write-ahead log, see scan_wal
+        @param path : the log file
+        @type path : string
+        @return : a generator of lists of (tablename, primary_key, row) changes
+    """
+    for _, data in scan_wal(path):
+        yield pickle.loads(data)
+
+
+def wal_length(path):
+    """
+    The length of the complete records at the start of a write-ahead log, what follows
+    them was torn by a crash
+    """
+    end = 0
+    for end, _ in scan_wal(path):
+        pass
+    return end
+
+
+def replay_wal(path, db):
+    """
+    Applies every record of a write-ahead log to db, marking the rows dirty
+    Rows are applied as they were committed, so foreign keys are not checked again
+        @param path : the log file
+        @type path : string
+        @param db : the hypergraph loaded from the shelve the log belongs to
+        @type db : a HypergraphDB
+        @return : the number of records replayed
+    """
+    replayed = 0
+    for changes in read_wal(path):
+        for tablename, primary_key, row in changes:
+            if row is not None:
+                put_row(db, tablename, primary_key, row)
+            elif primary_key in db[tablename]:
+                remove_row(db, tablename, primary_key)
+        replayed += 1
+    return replayed
+
+
 """element generation
 Each of these functions take values for every attribute of a table and convert them into an element fit for the table
 Use get_primary_key to get the key where each element should be stored at
@@ -192,23 +1454,26 @@ def parse_address(address):
 
 def calc_cost(db, orderid, userid):
     order = db["order"]
-    content = db["order_content"]
-    product = db["product"]
     the_ord = order[orderid]
     if the_ord["userid"] != userid:
         raise Exception("This is not the user's order")
-    oc = select(content, f"orderid={orderid}")
-    pidlist = project("productid", oc)
-    plist = select(product, f"productid${pidlist}")
-    prices = project("productid,price", plist)
-    quantities = project("productid,quantity", oc)
-    pq = inner_join(prices, quantities, "productid")
-    pq = rename(pq, "productid.price", "price")
-    pq = project("price,quantity", pq)
-    total = 0
-    for p, q in pq.items():
-        total += p * q
-    return total
+    return order_cost(db, orderid)
+
+
+def order_cost(db, orderid):
+    """
+    Computes SUM(price * quantity) over the contents of an order
+    """
+    content = db["order_content"]
+    product = db["product"]
+    oc = select_rows(content, f"orderid={orderid}")
+    pq = join_rows(
+        oc, product, "productid", columns="productid.price as price, quantity"
+    )
+    total = aggregate(
+        pq, {"total": ("sum", lambda row: row["price"] * row["quantity"])}
+    )
+    return total["total"]
 
 
 def detect_conditional(where):
@@ -225,30 +1490,389 @@ def detect_conditional(where):
     return conditional
 
 
-"""insert and update"""
+"""predicates
+Compiled conditions for select. A where string is parsed into these once and cached,
+and they can also be built directly, e.g. And(Gt("stock", 0), In("supplierid", [1, 2]))
+"""
 
+# stands in for an attribute a row does not have
+MISSING = object()
 
-def insert(db, tablename, primary_key, element):
-    """ "
-    Inserts element into db[tablename][primary_key]
-    Check foriegn key consistency: insert will fail if foreign key reference is invalid
-        @param db: the hypergraph in its entirety
-        @type db: a 3-level dictionary
-        @param tablename: which table is being inserted into
-        @type tablename: a string which is a key in db
-        @param primary_key: the key to insert the element at
-        @type primery_key: a number or a tuple of two numbers, which is a key in db[tablename]
-        @param element: the database element to be inserted
-        @type element: a 1-level dictionary
-        @return FOREIGN_KEY_ERROR if insert failed due to invalid foreign key
+
+class Predicate:
     """
-    tables_and_keys = table_keys()
-    # check foreign keys
-    # list of the tables this table has foreign keys to
-    try:
-        foreign_keys = get_foreign_key_list(tablename)
-        # for each table this table has foreign keys to
-        for fk in foreign_keys:
+    Base class of the conditions select accepts in place of a where string
+    compile() turns the predicate into a function of a row the first time it is called
+    probe() returns the candidate keys an index gives for the predicate,
+    or None if the table has to be scanned
+    selectivity() estimates the fraction of rows satisfying it, for the planner
+    """
+
+    _test = None
+
+    def compile(self):
+        if self._test is None:
+            self._test = self._compile()
+        return self._test
+
+    def test(self, row):
+        return self.compile()(row)
+
+    def probe(self, table):
+        return None
+
+    def selectivity(self):
+        return 0.1
+
+
+def index_for(table, attribute):
+    """
+    Returns the index a table keeps on attribute, None if it has none
+    """
+    return getattr(table, "indexes", {}).get(attribute)
+
+
+def is_primary_key(table, attribute):
+    """
+    Whether attribute is the whole primary key of a Table or RowTable
+    """
+    return table_keys().get(getattr(table, "name", None)) == attribute
+
+
+class Eq(Predicate):
+    """
+    attribute = value
+    Values of a different type are compared as strings, like the original "=" conditional
+    """
+
+    def __init__(self, attribute, value):
+        self.attribute = attribute
+        self.value = value
+        self.text = str(value)
+
+    def __repr__(self):
+        return f"{self.attribute} = {self.value!r}"
+
+    def _compile(self):
+        attribute, value, text, kind = (
+            self.attribute,
+            self.value,
+            self.text,
+            type(self.value),
+        )
+
+        def test(row):
+            field = row.get(attribute, MISSING)
+            if field.__class__ is kind:
+                return field == value
+            return field is not MISSING and str(field) == text
+
+        return test
+
+    def probe(self, table):
+        if is_primary_key(table, self.attribute):
+            return [self.value] if self.value in table else []
+        index = index_for(table, self.attribute)
+        if index is not None:
+            return index.lookup(self.text)
+        return None
+
+
+class In(Predicate):
+    """
+    attribute is one of values, the "$" conditional
+    Membership is a set lookup, values of a different type are compared as strings
+    """
+
+    def __init__(self, attribute, values):
+        self.attribute = attribute
+        self.values = set(values)
+        self.texts = {str(v) for v in self.values}
+        self.kinds = {type(v) for v in self.values}
+
+    def __repr__(self):
+        return f"{self.attribute} in {sorted(self.values, key=str)!r}"
+
+    def _compile(self):
+        attribute, values, texts, kinds = (
+            self.attribute,
+            self.values,
+            self.texts,
+            self.kinds,
+        )
+
+        def test(row):
+            field = row.get(attribute, MISSING)
+            if field.__class__ in kinds:
+                return field in values
+            return field is not MISSING and str(field) in texts
+
+        return test
+
+    def probe(self, table):
+        if is_primary_key(table, self.attribute):
+            return [v for v in self.values if v in table]
+        index = index_for(table, self.attribute)
+        if index is None:
+            return None
+        keys = set()
+        for text in self.texts:
+            keys.update(index.lookup(text))
+        return keys
+
+    def selectivity(self):
+        return min(1, 0.1 * len(self.values))
+
+
+class Compare(Predicate):
+    """
+    Base class of the ordering comparisons, rows whose attribute cannot be compared fail
+    """
+
+    symbol = ""
+
+    def __repr__(self):
+        return f"{self.attribute} {self.symbol} {self.value!r}"
+
+    def selectivity(self):
+        return 1 / 3
+
+    def probe(self, table):
+        index = getattr(table, "range_indexes", {}).get(self.attribute)
+        if index is None:
+            return None
+        # the index only holds numbers, which cannot be ordered against anything else
+        if not all(v is None or is_number(v) for v in self.bounds()):
+            return None
+        return index.range(*self.bounds(), *self.inclusive)
+
+    def _compile(self):
+        attribute, value, compare = self.attribute, self.value, self.compare
+
+        def test(row):
+            field = row.get(attribute)
+            if field is None:
+                return False
+            try:
+                return compare(field, value)
+            except TypeError:
+                return False
+
+        return test
+
+
+class Lt(Compare):
+    """
+    attribute < value
+    """
+
+    symbol = "<"
+    inclusive = (True, False)
+
+    def __init__(self, attribute, value):
+        self.attribute = attribute
+        self.value = value
+
+    def bounds(self):
+        return None, self.value
+
+    @staticmethod
+    def compare(field, value):
+        return field < value
+
+
+class Gt(Compare):
+    """
+    attribute > value
+    """
+
+    symbol = ">"
+    inclusive = (False, True)
+
+    def __init__(self, attribute, value):
+        self.attribute = attribute
+        self.value = value
+
+    def bounds(self):
+        return self.value, None
+
+    @staticmethod
+    def compare(field, value):
+        return field > value
+
+
+class Between(Compare):
+    """
+    low <= attribute <= high
+    """
+
+    inclusive = (True, True)
+
+    def __init__(self, attribute, low, high):
+        self.attribute = attribute
+        self.value = (low, high)
+
+    def bounds(self):
+        return self.value
+
+    def __repr__(self):
+        return f"{self.attribute} between {self.value[0]!r} and {self.value[1]!r}"
+
+    @staticmethod
+    def compare(field, value):
+        return value[0] <= field <= value[1]
+
+
+class And(Predicate):
+    """
+    Every one of predicates holds
+    Probes with whichever predicate an index narrows down the most
+    """
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __repr__(self):
+        return "(" + " and ".join(repr(p) for p in self.predicates) + ")"
+
+    def _compile(self):
+        tests = [p.compile() for p in self.predicates]
+        return lambda row: all(t(row) for t in tests)
+
+    def selectivity(self):
+        ret = 1
+        for p in self.predicates:
+            ret *= p.selectivity()
+        return ret
+
+    def probe(self, table):
+        best = None
+        for p in self.predicates:
+            keys = p.probe(table)
+            if keys is not None and (best is None or len(keys) < len(best)):
+                best = keys
+        return best
+
+
+class Or(Predicate):
+    """
+    At least one of predicates holds
+    Can only use indexes if every one of predicates can
+    """
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __repr__(self):
+        return "(" + " or ".join(repr(p) for p in self.predicates) + ")"
+
+    def _compile(self):
+        tests = [p.compile() for p in self.predicates]
+        return lambda row: any(t(row) for t in tests)
+
+    def selectivity(self):
+        return min(1, sum(p.selectivity() for p in self.predicates))
+
+    def probe(self, table):
+        keys = set()
+        for p in self.predicates:
+            found = p.probe(table)
+            if found is None:
+                return None
+            keys.update(found)
+        return keys
+
+
+class Not(Predicate):
+    """
+    predicate does not hold
+    """
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def __repr__(self):
+        return f"not {self.predicate!r}"
+
+    def _compile(self):
+        test = self.predicate.compile()
+        return lambda row: not test(row)
+
+    def selectivity(self):
+        return 1 - self.predicate.selectivity()
+
+
+def literal(text):
+    """
+    Converts the value of a where string to an int or float if it is written as one
+    Anything that would not print back as the same text stays a string
+    """
+    for kind in (int, float):
+        try:
+            value = kind(text)
+        except ValueError:
+            continue
+        if str(value) == text:
+            return value
+    return text
+
+
+@lru_cache(maxsize=1024)
+def parse_where(where):
+    """
+    Parses a where string of select into a Predicate, once per distinct string
+        @param where: selection condition in the format of <field name><conditional><condition>
+            with conditional one of =, <, > or $ (element of a list such as [1, 2, 3])
+        @type where: string
+        @return: a Predicate, or None for an empty where string
+    """
+    if len(where) == 0:
+        return None
+    conditional = detect_conditional(where)
+    if conditional == "":
+        raise ValueError(f"no conditional in where string {where!r}")
+    attribute, text = (x.strip() for x in where.split(conditional, 1))
+    if conditional == "=":
+        return Eq(attribute, literal(text))
+    if conditional == "<":
+        return Lt(attribute, literal(text))
+    if conditional == ">":
+        return Gt(attribute, literal(text))
+    text = text.replace("[", "").replace("]", "")
+    return In(attribute, [literal(t) for t in text.split(", ")])
+
+
+"""insert and update"""
+
+
+FOREIGN_KEY_ERROR = "foreign key error"
+
+
+def insert(db, tablename, primary_key, element, strict=False):
+    """ "
+    Inserts element into db[tablename][primary_key]
+    Check foriegn key consistency: insert will fail if foreign key reference is invalid
+        @param db: the hypergraph in its entirety
+        @type db: a 3-level dictionary
+        @param tablename: which table is being inserted into
+        @type tablename: a string which is a key in db
+        @param primary_key: the key to insert the element at
+        @type primery_key: a number or a tuple of two numbers, which is a key in db[tablename]
+        @param element: the database element to be inserted
+        @type element: a 1-level dictionary
+        @param strict: whether an invalid foreign key raises an exception instead,
+            the session methods insert strictly so a transaction rolls back
+        @type strict: boolean
+        @return FOREIGN_KEY_ERROR if insert failed due to invalid foreign key
+        @raise Exception: if strict and insert failed due to invalid foreign key
+    """
+    tables_and_keys = table_keys()
+    # check foreign keys
+    # list of the tables this table has foreign keys to
+    try:
+        foreign_keys = get_foreign_key_list(tablename)
+        # for each table this table has foreign keys to
+        for fk in foreign_keys:
             # find out the name of the foreign key (primary key shares name with foreign key)
             fk_name = tables_and_keys[fk]
             # find the value of the attribute with that name in element
@@ -257,15 +1881,17 @@ def insert(db, tablename, primary_key, element):
             # then this statement will throw an error, voiding the insert
             db[fk][fk_val]
     except KeyError:
-        print(
-            f"invalid {tablename} insert: foreign key {fk_name}:{fk_val} not present in {fk} table"
-        )
+        message = f"invalid {tablename} insert: foreign key {fk_name}:{fk_val} not present in {fk} table"
+        if strict:
+            raise Exception(message)
+        print(message)
+        return FOREIGN_KEY_ERROR
     else:
         # if foriegn keys are sound, then insert the element into the correct table
-        db[tablename][primary_key] = element
+        put_row(db, tablename, primary_key, element)
 
 
-def update(db, tablename, primary_key, attributes_values):
+def update(db, tablename, primary_key, attributes_values, strict=False):
     """
     Updates the attributes and values given at db[tablename][primary_key]
     If the primary_key is updated, then delete the old element before inserting the new one
@@ -280,10 +1906,13 @@ def update(db, tablename, primary_key, attributes_values):
         @type primary_key: a number or a tuple of two numbers, which is a key in db[tablename]
         @param attributes_values: the attributes to be updated and the value to update it to
         @type attributes_values: a dictionary whose keys are attributes of tablename
+        @param strict: see insert
+        @type strict: boolean
         @return FOREIGN_KEY_ERROR via insert if the updated element's foreign key is invalid
     """
     tables_and_keys = table_keys()
-    element = db[tablename][primary_key]
+    # work on a copy so the indexes can still see the old values
+    element = dict(db[tablename][primary_key])
     for a in attributes_values:
         element[a] = attributes_values[a]
     pkname = tables_and_keys[tablename]
@@ -291,53 +1920,145 @@ def update(db, tablename, primary_key, attributes_values):
         newpk = (element[pkname[0]], element[pkname[1]])
     else:
         newpk = element[pkname]
-    try:
-        insert(db, tablename, primary_key, element)
-        if newpk != primary_key:
-            print("deleting")
-            delete(db, tablename, primary_key)
-    except:
-        KeyError
+    if insert(db, tablename, newpk, element, strict) == FOREIGN_KEY_ERROR:
+        return FOREIGN_KEY_ERROR
+    if newpk != primary_key:
+        delete(db, tablename, primary_key)
 
 
 def delete(db, tablename, primary_key):
     """
     Pops db[tablename][primary_key], deleting the element
     If any other element in the database had primary_key as its foreign key, it get deleted too
-    This cascade deletion is recusrive
+    and so on down the cascade, see delete_many
         @param db: the hypergraph in its entirety
         @type db: a 3-level dictionary
         @param tablename: the table to delete an element from
         @type tablename: a string which is a key in db
         @param primary_key: the key to the element to be deleted
         @type primary_key: a number or a tuple of two numbers, which is a key in db[tablename]
+        @raise KeyError: if db[tablename] has no element at primary_key
     """
-    tables_and_keys = table_keys()
-    foreign_keys = table_foreign_keys()
-    # cascading delete only in this DB
-    # check every table which has a foriegn key
-    for foreign_table in foreign_keys:
-        # if the table being deleted from is a foriegn key for that table
-        fks = get_foreign_key_list(foreign_table)
-        if tablename in fks:
-            # check every element in the foriegn table
-            ft = db[foreign_table]
-            deleters = list()
-            for cascade in ft:
-                item = ft[cascade]
-                cascade_key = item[tables_and_keys[tablename]]
-                # if that element's foriegn key is the deleted element's primary key
-                # that means it must be deleted to avoid a reference error
-                if cascade_key == primary_key:
-                    # run a FULL DELETE to continue the cascade
-                    deleters.append(cascade_key)
-            for ck in deleters:
-                db = delete(db, foreign_table, ck)
-    # after all cascading has been completed
-    db[tablename].pop(primary_key)
+    if primary_key not in db[tablename]:
+        raise KeyError(primary_key)
+    delete_many(db, tablename, [primary_key])
     return db
 
 
+def delete_many(db, tablename, primary_keys, missing=None):
+    """
+    Deletes many elements of a table at once, cascading to every element referencing them
+    The whole cascade is found first (see cascade_keys) and then removed table by table,
+    the elements holding a foreign key before the elements it references
+    Keys the table does not have are skipped, or appended to missing if it is given
+        @param db: the hypergraph in its entirety
+        @type db: a 3-level dictionary
+        @param tablename: the table to delete elements from
+        @type tablename: a string which is a key in db
+        @param primary_keys: the keys of the elements to be deleted
+        @type primary_keys: iterable
+        @param missing: collects the keys that were not found
+        @type missing: list
+        @return: how many elements were deleted from each table, tables with none left out
+    """
+    table = db[tablename]
+    roots = []
+    for pk in primary_keys:
+        if pk in table:
+            roots.append(pk)
+        elif missing is not None:
+            missing.append(pk)
+    cascade = cascade_keys(db, tablename, roots)
+    counts = {}
+    for t in deletion_order():
+        keys = cascade.get(t)
+        if keys:
+            for pk in keys:
+                remove_row(db, t, pk)
+            counts[t] = len(keys)
+    return counts
+
+
+def cascade_keys(db, tablename, primary_keys):
+    """
+    Finds every element a delete of db[tablename][primary_keys] cascades to, themselves included
+    Works through a worklist instead of recursing, so every element is visited once
+    however deep the cascade goes or however many paths lead to it
+        @param primary_keys: keys of db[tablename]
+        @type primary_keys: iterable
+        @return: a dictionary of table name to the primary keys to delete from it, in the order found
+    """
+    cascade = {tablename: {}}
+    worklist = []
+    for pk in primary_keys:
+        if pk not in cascade[tablename]:
+            cascade[tablename][pk] = None
+            worklist.append((tablename, pk))
+    while worklist:
+        parent, pk = worklist.pop()
+        for child in referencing_tables(parent):
+            found = cascade.setdefault(child, {})
+            for ck in child_keys(db, child, parent, pk):
+                if ck not in found:
+                    found[ck] = None
+                    worklist.append((child, ck))
+    return {t: list(keys) for t, keys in cascade.items()}
+
+
+@lru_cache(maxsize=None)
+def referencing_tables(tablename):
+    """
+    The tables with a foreign key to tablename, the ones a delete from it cascades to
+    """
+    return tuple(
+        t for t in table_foreign_keys() if tablename in get_foreign_key_list(t)
+    )
+
+
+@lru_cache(maxsize=None)
+def deletion_order():
+    """
+    Every table, each one before the tables it has foreign keys to
+    Deleting in this order never removes an element while something still references it
+    """
+    order = []
+
+    def visit(tablename):
+        if tablename not in order:
+            for child in referencing_tables(tablename):
+                visit(child)
+            order.append(tablename)
+
+    for t in table_keys():
+        visit(t)
+    return tuple(order)
+
+
+def child_keys(db, child_table, parent_table, parent_key):
+    """
+    Finds the rows of child_table whose foreign key references db[parent_table][parent_key]
+    Uses the reverse foreign key index of child_table, only plain dictionaries are scanned
+        @param db: the hypergraph in its entirety
+        @type db: a 3-level dictionary
+        @param child_table: the table holding the foreign key
+        @type child_table: a string which is a key in db
+        @param parent_table: the table the foreign key references
+        @type parent_table: a string which is a key in db
+        @param parent_key: the primary key of the referenced row
+        @type parent_key: a number
+        @return: the primary keys of the child rows, as a new list
+    """
+    tables_and_keys = table_keys()
+    attribute = tables_and_keys[parent_table]
+    child = db[child_table]
+    if attribute == tables_and_keys[child_table]:
+        return [parent_key] if parent_key in child else []
+    index = getattr(child, "indexes", {}).get(attribute)
+    if index is not None:
+        return sorted(index.lookup(parent_key))
+    return [k for k in child if child[k][attribute] == parent_key]
+
+
 def get_primary_key(tablename, element):
     """
     Figures out the primary key of the given element according to its table
@@ -381,11 +2102,1110 @@ def get_foreign_key_list(tablename):
     return foreign_keys
 
 
-def clean_address(address):
-    addr = address
-    addr["zipcode"] = address["zip"]
-    del addr["zip"]
-    return addr
+def clean_address(address):
+    addr = address
+    addr["zipcode"] = address["zip"]
+    del addr["zip"]
+    return addr
+
+
+"""pipeline
+Pull-based operators over (primary key, row) pairs. Each one is a generator that takes the
+rows of the operator before it, so a query such as
+    project_rows(join_rows(select_rows(cart_item, "userid=1"), product, "productid"), columns)
+passes one row at a time from the table to the result and only the result is materialized,
+with dict(...) or a list of its rows. select, project and the joins wrap these.
+"""
+
+
+def scan(db, keys=None):
+    """
+    Yields the rows of a table, or only the rows under keys
+        @param db: table(tuple) represented as graph
+        @type db: 2-level dictionary
+        @param keys: the primary keys to read, default all of them in table order
+        @type keys: iterable
+    """
+    if keys is None:
+        keys = db
+    for k in keys:
+        yield k, db[k]
+
+
+def lookup_rows(db, keys, missing=None):
+    """
+    Yields the rows of a table under keys by direct lookup, in the order of keys
+    Keys the table does not have are skipped, or appended to missing if it is given
+        @param db: table(tuple) represented as graph
+        @type db: 2-level dictionary
+        @param keys: the primary keys to fetch
+        @type keys: iterable
+        @param missing: collects the keys that were not found
+        @type missing: list
+    """
+    for k in keys:
+        if k in db:
+            yield k, db[k]
+        elif missing is not None:
+            missing.append(k)
+
+
+def multi_get(db, keys, missing=None):
+    """
+    Batch point lookup, fetches many rows by primary key without a where string or a scan
+    Repeated keys are fetched once, see lookup_rows
+        @return: the rows found represented as graph, in the order of keys
+    """
+    return dict(lookup_rows(db, keys, missing))
+
+
+def as_predicate(where):
+    """
+    Returns where as a Predicate, parsing it if it is a where string (None if it is empty)
+    """
+    if isinstance(where, Predicate):
+        return where
+    return parse_where(where)
+
+
+def filter_rows(rows, where):
+    """
+    Yields the rows that satisfy where, a where string or a Predicate
+    """
+    test = as_predicate(where).compile()
+    for k, row in rows:
+        if test(row):
+            yield k, row
+
+
+def select_rows(db, where=""):
+    """
+    Yields the rows of a table that satisfy where, probing an index for them when
+    where allows it (see Predicate.probe) and scanning the table otherwise
+        @param db: table(tuple) represented as graph
+        @type db: 2-level dictionary
+        @param where: a where string of select or a Predicate
+        @type where: string or Predicate
+    """
+    predicate = as_predicate(where)
+    if predicate is None:
+        return scan(db)
+    keys = predicate.probe(db)
+    if keys is not None:
+        keys = sorted(keys)
+    return filter_rows(scan(db, keys), predicate)
+
+
+def ordered_rows(db, attribute, low=None, high=None, reverse=False):
+    """
+    Yields the rows of a table in the order of a numeric attribute, through its RangeIndex
+    Only the rows with low <= attribute <= high are read, a bound of None leaves that side open
+        @param db: table(tuple) represented as graph, with a range index on attribute
+        @type db: a Table or a RowTable
+        @param attribute: the attribute to order by, see table_range_indexes
+        @type attribute: string
+        @param reverse: True for the largest values first
+        @type reverse: boolean
+    """
+    keys = db.range_indexes[attribute].range(low, high)
+    if reverse:
+        keys = reversed(keys)
+    return scan(db, keys)
+
+
+@lru_cache(maxsize=256)
+def parse_columns(columns, key):
+    """
+    Parses the columns of a join into (output name, side, field) triples
+    Columns are comma-delimited, a field of the right row is named the way flatten names it,
+    <key>.<field>, and any column can be given another name with "as":
+        "orderid, productid.product_name as product_name"
+    side is True for fields of the right row
+    """
+    parsed = []
+    for column in columns.split(","):
+        field, _, alias = column.partition(" as ")
+        field = field.strip()
+        alias = alias.strip() or field
+        if field.startswith(key + "."):
+            parsed.append((alias, True, field[len(key) + 1 :]))
+        else:
+            parsed.append((alias, False, field))
+    return tuple(parsed)
+
+
+def aliased_row(columns, row, target):
+    """
+    Builds a joined row straight from the left row and the right row it references
+    Fields either row does not have are left out, like project does
+    """
+    ret = {}
+    for alias, in_right, field in columns:
+        source = target if in_right else row
+        if source is not None and field in source:
+            ret[alias] = source[field]
+    return ret
+
+
+def join_rows(rows, right, key, how="inner", columns=None):
+    """
+    Yields rows joined to the row of right their key field references, see hash_join
+    Right and outer joins yield the unreferenced rows of right once rows is exhausted
+    Neither side is changed. Without columns the joined rows are flattened copies of the left
+    row; with columns each row is built in one pass with only those columns, under their aliases
+    (see parse_columns), so no flatten or rename has to follow. In the unreferenced rows of right
+    the fields of the left row are empty, except the joining field which holds the right key
+        @param rows: the left side of the join
+        @type rows: iterable of (primary key, row)
+        @param right: table (tuple) at the right side of the join, keyed by the joined field
+        @type right: dictionary
+        @param key: name of joining field (attribute)
+        @type key: string
+        @param how: one of JOIN_TYPES
+        @type how: string
+        @param columns: comma-delimited columns of the joined rows, default every field
+        @type columns: string
+    """
+    if how not in JOIN_TYPES:
+        raise ValueError(f"unknown join type {how!r}")
+    if not key:
+        return
+    if columns is not None:
+        yield from aliased_join_rows(rows, right, key, how, parse_columns(columns, key))
+        return
+    unmatched = how in ("right", "outer")
+    referenced = set()
+    template = None
+    for k, row in rows:
+        fk = row[key]
+        if unmatched:
+            if template is None:
+                template = row
+            referenced.add(fk)
+        if fk in right:
+            target = right[fk]
+            if how in ("inner", "right") and len(target) == 0:
+                continue
+            yield k, joined_row(row, key, target)
+        elif how in ("left", "outer"):
+            yield k, flatten(row)
+    if unmatched:
+        for k in right:
+            if k not in referenced:
+                yield k, unmatched_row(template or {key: None}, key, right[k])
+
+
+def aliased_join_rows(rows, right, key, how, columns):
+    """
+    join_rows for parsed columns
+    """
+    unmatched = how in ("right", "outer")
+    referenced = set()
+    for k, row in rows:
+        fk = row[key]
+        if unmatched:
+            referenced.add(fk)
+        if fk in right:
+            target = right[fk]
+            if how in ("inner", "right") and len(target) == 0:
+                continue
+            yield k, aliased_row(columns, row, target)
+        elif how in ("left", "outer"):
+            yield k, aliased_row(columns, row, None)
+    if unmatched:
+        for k in right:
+            if k not in referenced:
+                empty = {field: "" for _, in_right, field in columns if not in_right}
+                empty[key] = k
+                yield k, aliased_row(columns, empty, right[k])
+
+
+def rename_rows(rows, names):
+    """
+    Yields rows with their fields renamed, rows are copied rather than changed
+        @param names: the new name of each field to rename
+        @type names: dictionary of old name to new name
+    """
+    for k, row in rows:
+        yield k, {names.get(kk, kk): v for kk, v in row.items()}
+
+
+def project_rows(rows, columns):
+    """
+    Yields rows reduced to columns, fields a row does not have are left out
+        @param columns: comma-delimited list of fields (attributes) to project, or *
+        @type columns: string
+    """
+    columns = [x.strip() for x in columns.split(",")]
+    if columns[0] == "*":
+        yield from rows
+        return
+    for k, row in rows:
+        yield k, {kk: row[kk] for kk in columns if kk in row}
+
+
+def limit(rows, count):
+    """
+    Yields the first count rows and stops pulling from the operators before it
+    """
+    return islice(rows, count)
+
+
+def values(rows):
+    """
+    Materializes the rows of a pipeline as a list, the way the API functions return them
+    """
+    return [row for _, row in rows]
+
+
+# aggregate function name -> (initial value, function adding a value to it)
+AGGREGATES = {
+    "count": (lambda: 0, lambda total, value: total + 1),
+    "sum": (lambda: 0, lambda total, value: total + value),
+    "min": (lambda: None, lambda low, value: value if low is None else min(low, value)),
+    "max": (
+        lambda: None,
+        lambda high, value: value if high is None else max(high, value),
+    ),
+    # appends in place, every group starts with a list of its own
+    "list": (list, lambda values, value: values.append(value) or values),
+}
+
+
+def aggregate_functions(aggregates):
+    """
+    Checks the aggregates of group_rows and returns (name, initial, add, field) for each
+    """
+    ret = []
+    for name, (function, field) in aggregates.items():
+        if function not in AGGREGATES:
+            raise ValueError(f"unknown aggregate function {function!r}")
+        initial, add = AGGREGATES[function]
+        ret.append((name, initial, add, field))
+    return ret
+
+
+def group_rows(rows, by, aggregates):
+    """
+    Hash aggregation: yields one row per distinct value of the by fields, holding those fields
+    and the aggregates of the rows with that value. Every row is read once and only the
+    running aggregates are kept, nothing is yielded before rows is exhausted.
+    Rows without the field of an aggregate are not added to it.
+        @param rows: the rows to group
+        @type rows: iterable of (primary key, row)
+        @param by: comma-delimited fields to group on, an empty string makes a single group
+        @type by: string
+        @param aggregates: the aggregates of each group, under their names in the yielded rows
+            field is a field name, a function of the row, or None to count rows
+        @type aggregates: dictionary of name to (one of AGGREGATES, field)
+        @return: (value of the by field, or tuple of them for several, group row) pairs
+    """
+    by = [x.strip() for x in by.split(",") if x.strip()]
+    functions = aggregate_functions(aggregates)
+    groups = {}
+    for _, row in rows:
+        if len(by) == 1:
+            group = row.get(by[0])
+        else:
+            group = tuple(row.get(field) for field in by)
+        totals = groups.get(group)
+        if totals is None:
+            totals = groups[group] = [initial() for _, initial, _, _ in functions]
+        for i, (_, _, add, field) in enumerate(functions):
+            if field is None:
+                value = row
+            elif callable(field):
+                value = field(row)
+            elif field in row:
+                value = row[field]
+            else:
+                continue
+            totals[i] = add(totals[i], value)
+    if not by and not groups:
+        # like SQL, aggregating nothing still gives one row
+        groups[()] = [initial() for _, initial, _, _ in functions]
+    for group, totals in groups.items():
+        ret = {}
+        if len(by) == 1:
+            ret[by[0]] = group
+        else:
+            ret.update(zip(by, group))
+        for (name, _, _, _), total in zip(functions, totals):
+            ret[name] = total
+        yield group, ret
+
+
+def aggregate(rows, aggregates):
+    """
+    Returns the aggregates of all of rows as one row, see group_rows
+    """
+    return next(group_rows(rows, "", aggregates))[1]
+
+
+def group_by(db, by, aggregates):
+    """
+    Groups a table, see group_rows
+        @param db: table(tuple) represented as graph
+        @type db: 2-level dictionary
+        @return: the groups represented as graph, keyed by the value of the by fields
+    """
+    return dict(group_rows(scan(db), by, aggregates))
+
+
+"""joins
+The join operators below map onto these. The left table holds the joining field, which
+references the primary key of the right table, so the right table already is the hash table
+of a hash join and the only thing to build is the set of keys the left table references.
+"""
+
+JOIN_TYPES = ("inner", "left", "right", "outer")
+
+
+def joined_row(row, key, target):
+    """
+    Returns a flattened copy of row with its joining field replaced by the row it references
+    """
+    row = dict(row)
+    row[key] = target
+    return flatten(row)
+
+
+def unmatched_row(template, key, target):
+    """
+    Returns the row a right or outer join makes for a right row no left row references
+    Every field of template is empty except the joining field, which holds target
+    """
+    row = {kk: "" for kk in template}
+    row[key] = target
+    return flatten(row)
+
+
+def hash_join(left, right, key, how="inner", columns=None):
+    """
+    Joins every row of left to the row of right its key field references
+    Rows are copied, neither table is changed, see join_rows for the streaming form
+    Runs in O(|left| + |right|) where the operators used to scan left once per row of right
+        @param left: table (tuple) at the left side of the join
+        @type left: dictionary
+        @param right: table (tuple) at the right side of the join, keyed by the joined field
+        @type right: dictionary
+        @param key: name of joining field (attribute)
+        @type key: string
+        @param how: one of JOIN_TYPES
+        @type how: string
+        @param columns: comma-delimited columns of the joined rows (see join_rows)
+        @type columns: string
+        @return: joined table represented as graph, keyed like left, then like right
+            for the right rows no left row references (right and outer joins)
+            inner and right joins leave out left rows that reference an empty row
+    """
+    return dict(join_rows(scan(left), right, key, how, columns))
+
+
+def merge_join(left, right, key, how="inner"):
+    """
+    Sort-merge variant of hash_join, for tables that are already ordered on the joining field
+    (rows are usually inserted in key order). Sorting an ordered run is linear, so no hash set is
+    built and the tables are read in a single pass each.
+    The joining field and the keys of right must be comparable with each other.
+        @param left: table (tuple) at the left side of the join
+        @type left: dictionary
+        @param right: table (tuple) at the right side of the join, keyed by the joined field
+        @type right: dictionary
+        @param key: name of joining field (attribute)
+        @type key: string
+        @param how: one of JOIN_TYPES
+        @type how: string
+        @return: joined table represented as graph, with the same rows as hash_join
+            in the order of the joining field
+    """
+    if how not in JOIN_TYPES:
+        raise ValueError(f"unknown join type {how!r}")
+    if not key:
+        return {}
+    left_keys = sorted(left, key=lambda k: left[k][key])
+    right_keys = sorted(right)
+    template = left[left_keys[0]] if left_keys else {key: None}
+    ret = {}
+    i = 0
+    # whether a left row referenced right_keys[i]
+    matched = False
+    for k in left_keys:
+        row = left[k]
+        fk = row[key]
+        while i < len(right_keys) and right_keys[i] < fk:
+            if not matched and how in ("right", "outer"):
+                rk = right_keys[i]
+                ret[rk] = unmatched_row(template, key, right[rk])
+            i += 1
+            matched = False
+        if i < len(right_keys) and right_keys[i] == fk:
+            matched = True
+            target = right[fk]
+            if how in ("inner", "right") and len(target) == 0:
+                continue
+            ret[k] = joined_row(row, key, target)
+        elif how in ("left", "outer"):
+            ret[k] = flatten(row)
+    if how in ("right", "outer"):
+        for rk in right_keys[i + matched :]:
+            ret[rk] = unmatched_row(template, key, right[rk])
+    return ret
+
+
+"""planner
+A Query names its tables under aliases, the where condition of each table, the foreign keys
+joining them and the columns it returns. plan() picks how to read each table and in what order
+to join them from the row counts of the tables, the indexes they keep and estimated selectivities.
+"""
+
+
+def has_index(table, attribute):
+    """
+    Whether the rows of a table with a given attribute value can be found without a scan
+    """
+    return is_primary_key(table, attribute) or index_for(table, attribute) is not None
+
+
+class Step:
+    """
+    One operator of a plan
+        method is how the rows of the table are found:
+            scan: every row of the table is read
+            probe: the rows come from the primary key or an index (keys holds them)
+            lookup: the joined row is fetched by the foreign key of a row joined before
+            index: the joined rows are found through the index on their foreign key
+            hash: the table is read once into a hash table on its foreign key
+        rows is the estimated number of rows leaving the step, cost the estimated rows read
+    Running a plan with analyze set records the actual rows_in, rows_out and seconds of each step
+    """
+
+    # whether each method finds its rows through the primary key or an index
+    INDEXED = {
+        "scan": False,
+        "probe": True,
+        "lookup": True,
+        "index": True,
+        "hash": False,
+    }
+
+    def __init__(
+        self, alias, tablename, method, predicate, rows, cost, keys=None, join=None
+    ):
+        self.alias = alias
+        self.tablename = tablename
+        self.method = method
+        self.predicate = predicate
+        self.rows = rows
+        self.cost = cost
+        self.keys = keys
+        # (child alias, foreign key field, parent alias) of the joins steps
+        self.join = join
+        self.rows_in = 0
+        self.rows_out = 0
+        # including the time spent in the steps before it
+        self.seconds = 0.0
+
+    def counted(self, rows):
+        """
+        Yields rows, counting them as the rows in of the step
+        """
+        for row in rows:
+            self.rows_in += 1
+            yield row
+
+    def timed(self, rows):
+        """
+        Yields the rows leaving the step, counting them and timing how long each took
+        """
+        rows = iter(rows)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                self.seconds += time.perf_counter() - start
+                return
+            self.seconds += time.perf_counter() - start
+            self.rows_out += 1
+            yield row
+
+    def access(self):
+        """
+        How the step reads its table, for EXPLAIN
+        """
+        if self.INDEXED[self.method]:
+            return "index"
+        if self.method == "hash" and self.keys is not None:
+            return "index"
+        return "full scan"
+
+    def __repr__(self):
+        text = f"{self.method} {self.tablename} as {self.alias}"
+        if self.join is not None:
+            child, field, parent = self.join
+            text += f" on {child}.{field} = {parent}"
+        if self.predicate is not None:
+            text += f" where {self.predicate!r}"
+        return text + f" (rows={self.rows:.0f} cost={self.cost:.0f})"
+
+
+class Plan:
+    """
+    The steps a Query runs, in order. The first step reads a table, each later one joins a table
+    to the rows of the steps before it
+    """
+
+    def __init__(self, query, steps):
+        self.query = query
+        self.steps = steps
+        self.cost = sum(step.cost for step in steps)
+
+    def __repr__(self):
+        return "\n".join(repr(step) for step in self.steps)
+
+    def explain(self, analyze=False):
+        """
+        Returns the operator tree of the plan as text, the last step on top
+        With analyze, each operator also gets the actual rows in, rows out and time
+        recorded by running the plan (see Query.run)
+        """
+        columns = ", ".join(
+            f"{alias}.{field} as {name}" for name, alias, field in self.query.columns
+        )
+        lines = [f"project {columns} (cost={self.cost:.0f})"]
+        before = 0.0
+        analysis = []
+        for step in self.steps:
+            analysis.append(
+                f"actual rows in={step.rows_in} rows out={step.rows_out} "
+                f"time={(step.seconds - before) * 1000:.3f}ms {step.access()}"
+            )
+            before = step.seconds
+        for depth, step in enumerate(reversed(self.steps), 1):
+            indent = "  " * depth
+            lines.append(f"{indent}-> {step!r}")
+            if analyze:
+                lines.append(f"{indent}     {analysis[-depth]}")
+        return "\n".join(lines)
+
+
+class Query:
+    """
+    A query over the hypergraph, expressed without saying how to run it
+        @param tables: the tables of the query under the aliases the other arguments use
+        @type tables: dictionary of alias to table name
+        @param where: the condition each table's rows must satisfy, if any
+        @type where: dictionary of alias to a where string of select or a Predicate
+        @param joins: foreign keys joining the tables, a row of child whose field
+            equals the primary key of a row of parent is joined to it
+        @type joins: list of (child alias, field, parent alias)
+        @param columns: comma-delimited <alias>.<field> columns, each optionally named with "as"
+        @type columns: string
+    """
+
+    def __init__(self, tables, where=None, joins=(), columns=""):
+        self.tables = tables
+        self.where = {alias: as_predicate(w) for alias, w in (where or {}).items()}
+        self.joins = list(joins)
+        self.columns = []
+        for column in columns.split(","):
+            field, _, name = column.partition(" as ")
+            alias, _, field = field.strip().partition(".")
+            self.columns.append((name.strip() or field, alias, field))
+
+    def access(self, db, alias):
+        """
+        The cheapest way to read the rows of one table satisfying its where condition
+        """
+        tablename = self.tables[alias]
+        table = db[tablename]
+        predicate = self.where.get(alias)
+        if predicate is None:
+            return Step(alias, tablename, "scan", None, len(table), len(table))
+        keys = predicate.probe(table)
+        if keys is None:
+            rows = len(table) * predicate.selectivity()
+            return Step(alias, tablename, "scan", predicate, rows, len(table))
+        keys = sorted(keys)
+        return Step(alias, tablename, "probe", predicate, len(keys), len(keys), keys)
+
+    def join_step(self, db, alias, bound, rows):
+        """
+        The cheapest way to join the table under alias to rows rows of the aliases in bound
+        Returns None if no join connects it to them
+        """
+        tablename = self.tables[alias]
+        table = db[tablename]
+        predicate = self.where.get(alias)
+        selectivity = 1 if predicate is None else predicate.selectivity()
+        best = None
+        for join in self.joins:
+            child, field, parent = join
+            if child in bound and parent == alias:
+                # every child row references at most one parent row
+                step = Step(
+                    alias, tablename, "lookup", predicate, rows * selectivity, rows
+                )
+            elif parent in bound and child == alias:
+                fanout = len(table) / max(len(db[self.tables[parent]]), 1)
+                out = rows * fanout * selectivity
+                # the hash table is built from the rows satisfying the where condition
+                access = self.access(db, alias)
+                cost = access.cost + access.rows + rows
+                step = Step(alias, tablename, "hash", predicate, out, cost, access.keys)
+                if has_index(table, field) and rows * (1 + fanout) < step.cost:
+                    step = Step(
+                        alias, tablename, "index", predicate, out, rows * (1 + fanout)
+                    )
+            else:
+                continue
+            step.join = join
+            if best is None or step.cost < best.cost:
+                best = step
+        return best
+
+    def plan(self, db):
+        """
+        Returns the cheapest Plan over every order of the tables in which each table
+        after the first is joined to one before it
+        """
+        best = None
+        for alias in self.tables:
+            first = self.access(db, alias)
+            for steps in self.join_orders(db, [first]):
+                plan = Plan(self, steps)
+                if best is None or plan.cost < best.cost:
+                    best = plan
+        return best
+
+    def join_orders(self, db, steps):
+        """
+        Yields every way to extend steps into a plan joining all the tables
+        """
+        if len(steps) == len(self.tables):
+            yield steps
+            return
+        bound = {step.alias for step in steps}
+        for alias in self.tables:
+            if alias in bound:
+                continue
+            step = self.join_step(db, alias, bound, steps[-1].rows)
+            if step is not None:
+                yield from self.join_orders(db, steps + [step])
+
+    def run(self, db, plan=None, analyze=False):
+        """
+        Runs the query and returns its rows as a list
+            @param db: the hypergraph in its entirety
+            @type db: a 3-level dictionary
+            @param plan: the plan to run, default the one plan() picks
+            @type plan: Plan
+            @param analyze: whether to record the rows and time of each step in the plan
+            @type analyze: boolean
+        """
+        if plan is None:
+            plan = self.plan(db)
+        bindings = None
+        for step in plan.steps:
+            bindings = self.run_step(db, step, bindings, analyze)
+            if analyze:
+                bindings = step.timed(bindings)
+        return [self.project(binding) for binding in bindings]
+
+    def explain(self, db, analyze=False):
+        """
+        Returns the plan the query runs with as text, see Plan.explain
+        With analyze the query is run to measure each step, and its rows are thrown away
+        """
+        plan = self.plan(db)
+        if analyze:
+            self.run(db, plan, analyze=True)
+        return plan.explain(analyze)
+
+    def run_step(self, db, step, bindings, analyze=False):
+        """
+        Yields the bindings, alias to (primary key, row), that leave a step
+        The rows in of a step are the rows it reads from its table if it is the first one,
+        otherwise the bindings of the steps before it
+        """
+        table = db[step.tablename]
+        test = step.predicate.compile() if step.predicate is not None else None
+        alias = step.alias
+        if step.method in ("scan", "probe"):
+            rows = scan(table, step.keys)
+            if analyze:
+                rows = step.counted(rows)
+            for k, row in rows:
+                if test is None or test(row):
+                    yield {alias: (k, row)}
+            return
+        child, field, parent = step.join
+        # joins beyond the one the step runs on are checked once both sides are bound
+        checks = [j for j in self.joins if j != step.join and alias in (j[0], j[2])]
+        if step.method == "hash":
+            groups = {}
+            for k, row in scan(table, step.keys):
+                if test is None or test(row):
+                    groups.setdefault(row[field], []).append((k, row))
+        if analyze:
+            bindings = step.counted(bindings)
+        for binding in bindings:
+            if step.method == "lookup":
+                fk = binding[child][1][field]
+                matches = [(fk, table[fk])] if fk in table else ()
+            elif step.method == "index":
+                pk = binding[parent][0]
+                matches = [(k, table[k]) for k in sorted(Eq(field, pk).probe(table))]
+            else:
+                matches = groups.get(binding[parent][0], ())
+            for k, row in matches:
+                if step.method != "hash" and test is not None and not test(row):
+                    continue
+                joined = dict(binding)
+                joined[alias] = (k, row)
+                if all(self.joined(joined, j) for j in checks):
+                    yield joined
+
+    @staticmethod
+    def joined(binding, join):
+        """
+        Whether the rows of a binding satisfy a join, or do not both take part in it yet
+        """
+        child, field, parent = join
+        if child not in binding or parent not in binding:
+            return True
+        return binding[child][1].get(field, MISSING) == binding[parent][0]
+
+    def project(self, binding):
+        """
+        Builds a result row from a binding, columns its rows do not have are left out
+        """
+        ret = {}
+        for name, alias, field in self.columns:
+            row = binding[alias][1]
+            if field in row:
+                ret[name] = row[field]
+        return ret
+
+
+"""queries
+The Queries behind the searches, so they can also be explained (see HypergraphSession.explain)
+"""
+
+
+class ViewQuery:
+    """
+    A query answered by reading the rows of a materialized view instead of joining its tables
+    It runs and explains like a Query
+        @param name: the name of the view
+        @type name: a string which is a key in materialized_views()
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def run(self, db, plan=None, analyze=False):
+        """
+        Returns the rows of the view as a list, building it if this db has not read it yet
+        """
+        return list(view_rows(db, self.name).values())
+
+    def explain(self, db, analyze=False):
+        """
+        Returns how the view is read as text
+        A view db has not built yet is built from its tables by the first read,
+        afterwards insert, update and delete keep it current
+        With analyze the view is read and the actual rows out and time are reported
+        """
+        view = db.views.get(self.name)
+        tables = ", ".join(materialized_views()[self.name].tables)
+        if view is None:
+            source = f"not built, the first read builds it from {tables}"
+        else:
+            source = f"rows={len(view.rows)}, maintained on changes to {tables}"
+        lines = [f"read view {self.name} ({source})"]
+        if analyze:
+            start = time.perf_counter()
+            rows = self.run(db)
+            seconds = time.perf_counter() - start
+            access = "built from its tables" if view is None else "view rows"
+            lines.append(
+                f"     actual rows out={len(rows)} time={seconds * 1000:.3f}ms {access}"
+            )
+        return "\n".join(lines)
+
+
+def search_product_query():
+    """
+    The query of search_product, which reads the in_stock_products view
+    """
+    return ViewQuery("in_stock_products")
+
+
+def items_in_cart_query(userid):
+    """
+    The Query of get_items_in_cart
+    """
+    return Query(
+        {"c": "cart_item", "p": "product"},
+        where={"c": f"userid={userid}"},
+        joins=[("c", "productid", "p")],
+        columns="p.productid, p.product_name, p.price, c.quantity",
+    )
+
+
+def orders_query(userid):
+    """
+    The Query of get_orders
+    """
+    return Query(
+        {"o": "order", "oc": "order_content", "p": "product"},
+        where={"o": f"userid={userid}"},
+        joins=[("oc", "orderid", "o"), ("oc", "productid", "p")],
+        columns="o.orderid, p.productid, p.product_name, p.price, oc.quantity, "
+        "o.order_status",
+    )
+
+
+"""materialized views
+Query results kept in memory or in the shelve and updated row by row as insert, update and
+delete change the tables they are computed from, instead of being computed again on every read
+"""
+
+
+class MaterializedView(ABC):
+    """
+    Base class of the views in materialized_views
+    A view is built from the tables the first time it is read (see view_rows), afterwards
+    every change to one of its tables refreshes only the view rows it affects
+    A persisted view is never built: like the entries of a HashIndex, each of its rows is stored
+    under its own shelve key and only read when looked up (see view_row). A change to its tables
+    marks the rows it affects, whether or not the view was read, and they are computed again
+    when they are next looked up or committed. Rows that were never stored, such as those of a
+    shelve written before the view was persisted, are computed when looked up and stored with
+    the next commit.
+    Subclasses give the tables they read and implement keys, affected and compute
+        @param name : the view's name in materialized_views
+        @type name : string
+        @param hypergraph : the shelve a persisted view stores its rows in
+        @type hypergraph : a shelve
+    """
+
+    tables = ()
+    persisted = False
+
+    def __init__(self, name, hypergraph=None):
+        self.prefix = f"__view__:{name}="
+        self.hypergraph = hypergraph
+        self.rows = {}
+        # the rows of a persisted view to compute again and store with the next commit
+        self.dirty = set()
+
+    def build(self, db):
+        self.rows = {}
+        self.refresh(db, self.keys(db))
+
+    def row(self, db, key):
+        """
+        The view row under key, None if there is none
+        """
+        if not self.persisted:
+            return self.rows.get(key)
+        try:
+            return self.rows[key]
+        except KeyError:
+            pass
+        row = MISSING
+        if key not in self.dirty:
+            row = self.hypergraph.get(self.prefix + str(key), MISSING)
+        if row is MISSING:
+            row = self.compute(db, key)
+            self.dirty.add(key)
+        self.rows[key] = row
+        return row
+
+    def refresh(self, db, keys):
+        """
+        Computes the view rows under keys again, dropping the ones that no longer exist
+        A persisted view only marks them to be computed when they are next needed
+        """
+        for k in keys:
+            if self.persisted:
+                self.rows.pop(k, None)
+                self.dirty.add(k)
+                continue
+            row = self.compute(db, k)
+            if row is None:
+                self.rows.pop(k, None)
+            else:
+                self.rows[k] = row
+
+    def flush(self, db):
+        """
+        Stores the rows of a persisted view marked since the last flush, None for the rows
+        it no longer has
+        """
+        for k in list(self.dirty):
+            self.hypergraph[self.prefix + str(k)] = self.row(db, k)
+        self.dirty = set()
+
+    @abstractmethod
+    def keys(self, db):
+        """
+        Every key the view can have a row under
+        """
+
+    @abstractmethod
+    def affected(self, db, tablename, primary_key, old, new):
+        """
+        The keys of the view rows a change to db[tablename][primary_key] can affect
+        old is the row before the change, None if it was inserted, and new the row after it,
+        None if it was deleted
+        """
+
+    @abstractmethod
+    def compute(self, db, key):
+        """
+        The view row under key, None if there is none
+        """
+
+
+class InStockProducts(MaterializedView):
+    """
+    The products with stock, with the name of their supplier, keyed by productid
+    The listing of search_product, the products joined to their suppliers where stock > 0
+    The view is not persisted: every session builds it with its first read
+    """
+
+    tables = ("product", "supplier")
+    in_stock = parse_where("stock > 0")
+
+    def keys(self, db):
+        return db["product"]
+
+    def affected(self, db, tablename, primary_key, old, new):
+        if tablename == "product":
+            return [primary_key]
+        return child_keys(db, "product", "supplier", primary_key)
+
+    def compute(self, db, key):
+        product = db["product"].get(key)
+        if product is None or not self.in_stock.test(product):
+            return None
+        supplier = db["supplier"].get(product["supplierid"])
+        if supplier is None:
+            return None
+        return {
+            "productid": product["productid"],
+            "product_name": product["product_name"],
+            "price": product["price"],
+            "stock": product["stock"],
+            "supplier_name": supplier["supplier_name"],
+        }
+
+
+class OrderTotals(MaterializedView):
+    """
+    The cost of every order (see order_cost), keyed by orderid
+    The view is persisted, so a total is one shelve read even in a new session
+    """
+
+    tables = ("order", "order_content", "product")
+    persisted = True
+
+    def keys(self, db):
+        return db["order"]
+
+    def affected(self, db, tablename, primary_key, old, new):
+        if tablename == "order":
+            # only a deleted order changes its total, status updates do not
+            return [] if new is not None else [primary_key]
+        if tablename == "order_content":
+            return [primary_key[0]]
+        if old is not None and new is not None and old.get("price") == new.get("price"):
+            # stock updates such as fulfill_order's leave every total as it was
+            return []
+        # a product's price changed, it is in the totals of every order holding it
+        return {ck[0] for ck in child_keys(db, "order_content", "product", primary_key)}
+
+    def compute(self, db, key):
+        if key not in db["order"]:
+            return None
+        return order_cost(db, key)
+
+
+def order_total(db, orderid, userid, verify=False):
+    """
+    calc_cost answered by a lookup in the order_totals view
+        @param verify: whether to compute the cost with calc_cost as well and raise an exception
+            if the maintained total differs
+        @type verify: boolean
+    """
+    if db["order"][orderid]["userid"] != userid:
+        raise Exception("This is not the user's order")
+    total = view_row(db, "order_totals", orderid)
+    if verify:
+        cost = calc_cost(db, orderid, userid)
+        if total != cost:
+            raise Exception(
+                f"Maintained total {total} of order {orderid} is not its cost {cost}"
+            )
+    return total
+
+
+def view_rows(db, name):
+    """
+    Returns the rows of a materialized view, building it the first time it is read
+        @param db: the hypergraph in its entirety
+        @type db: a HypergraphDB
+        @param name: the name of the view
+        @type name: a string which is a key in materialized_views()
+        @return: the rows of the view represented as graph
+    """
+    return materialized_view(db, name).rows
+
+
+def view_row(db, name, key):
+    """
+    Returns the row of a materialized view under key, None if it has none
+    Persisted views read it from the shelve, see MaterializedView
+    """
+    return materialized_view(db, name).row(db, key)
+
+
+def materialized_view(db, name):
+    """
+    Returns a materialized view of db, creating it the first time it is used
+    """
+    view = db.views.get(name)
+    if view is None:
+        view = materialized_views()[name](name, db.hypergraph)
+        if not view.persisted:
+            view.build(db)
+        db.views[name] = view
+    return view
+
+
+def update_views(db, tablename, primary_key, old, new):
+    """
+    Refreshes the materialized views after db[tablename][primary_key] changed from old
+    to new, either of which is None if the row was inserted or deleted
+    Views that are not persisted are only refreshed once built
+    Does nothing for plain dictionaries, which have no views
+    """
+    views = getattr(db, "views", None)
+    if views is None:
+        return
+    for name, view_class in materialized_views().items():
+        if tablename not in view_class.tables:
+            continue
+        view = views.get(name)
+        if view is None:
+            if not view_class.persisted:
+                continue
+            view = materialized_view(db, name)
+        view.refresh(db, view.affected(db, tablename, primary_key, old, new))
 
 
 """THE FUNCTIONS BELOW ARE NOT ORIGINAL WORK
@@ -425,68 +3245,32 @@ def select(db, where=""):
     Select (restriction) operator.
     Taken from Mapping Relational Operations onto Hypergraph Model
     Additional code added to support <, >, and in
+    The where string is parsed into a Predicate once (see parse_where)
+    "=" and "$" conditionals on the primary key, an indexed attribute (see indexed_attributes)
+    or the first column of a composite primary key probe instead of scanning
+    Materializes select_rows
         @param db: table(tuple) represented as graph
         @type db: 2-level dictionary
         @param where: selection condition in the format of <field name>=<condition>
-        @type where: formatted string
+        @type where: formatted string or a Predicate
         @default where: empty string
         @return: selected (restricted) table represented as graph
     """
-    table = []
-    conditional = detect_conditional(where)
-    if len(where) > 0:
-        where = where.split(conditional, 1)  # to avoid oversplitting
-        where[0] = where[0].strip()
-        where[1] = where[1].strip()
-    if conditional == "$":
-        where[1] = where[1].replace("[", "")
-        where[1] = where[1].replace("]", "")
-        table = where[1].split(", ")
-    ret = {}
-    for k in db:
-        try:
-            field = ""
-            satisfy = False
-            if len(where) == 2:
-                field = db[k][where[0]]
-                if conditional == "=":
-                    satisfy = str(field) == str(where[1])
-                elif conditional == ">":
-                    satisfy = field > int(where[1])
-                elif conditional == "<":
-                    satisfy = field < int(where[1])
-                elif conditional == "$":
-                    satisfy = str(field) in table
-            if satisfy or len(where) == 0:
-                ret[k] = db[k]
-        except KeyError:
-            pass
-    return ret
+    return dict(select_rows(db, where))
 
 
 def project(columns, db):
     """THIS FUNCTION IS NOT ORIGINAL WORK
     Projection operator.
     Taken from Mapping Relational Operations onto Hypergraph Model
+    Materializes project_rows
         @param columns: comma-delimited list of fields (attributes) to project
         @type columns: string
         @param db: table(tuple) represented as graph
         @type db: 2-level dictionary
         @return: projected table represented as graph
     """
-    columns = [x.strip() for x in columns.split(",")]
-    ret = {}
-    for k in db:
-        if columns[0] == "*":
-            ret[k] = db[k]
-        else:
-            ret[k] = {}
-            for kk in columns:
-                try:
-                    ret[k][kk] = db[k][kk]
-                except KeyError:
-                    pass
-    return ret
+    return dict(project_rows(scan(db), columns))
 
 
 def left_join(left, right, key=None):
@@ -495,6 +3279,7 @@ def left_join(left, right, key=None):
     Left join operator.
     Taken from Mapping Relational Operations onto Hypergraph Model
     Modification made to preserve left's foreign key
+    Rewritten as a hash join (see hash_join)
         @param left: table (tuple) at the left side of the join
         @type left: dictionary
         @param right: table (tuple) at the right side of the join
@@ -503,17 +3288,7 @@ def left_join(left, right, key=None):
         @type key: string
         @return: joined table represented as graph
     """
-    if not key:
-        return {}
-    ret = {}
-    for k in left:
-        ret[k] = left[k]
-        fk = left[k][key]
-        if fk in right:
-            ret[k][key] = right[fk]
-        ret[k] = flatten(ret[k])
-        left[k][key] = fk
-    return ret
+    return hash_join(left, right, key, "left")
 
 
 def inner_join(left, right, key=None):
@@ -521,6 +3296,7 @@ def inner_join(left, right, key=None):
     Inner join operator
     Taken from Mapping Relational Operations onto Hypergraph Model
     Modification made to preserve left's foreign key
+    Rewritten as a hash join (see hash_join)
         @param left: table (tuple) at the left side of the join
         @type left: dictionary
         @param right: table (tuple) at the right side of the join
@@ -529,19 +3305,7 @@ def inner_join(left, right, key=None):
         @type key: string
         @return: joined table represented as graph
     """
-    if not key:
-        return {}
-    ret = {}
-    for k in left:
-        fk = left[k][key]
-        if fk in right:
-            if len(right[fk]) > 0:
-                # ret[k] = copy.copy(left[k])
-                ret[k] = left[k]
-                ret[k][key] = right[fk]
-                ret[k] = flatten(ret[k])
-                left[k][key] = fk
-    return ret
+    return hash_join(left, right, key, "inner")
 
 
 def right_join(left, right, key=None):
@@ -550,6 +3314,7 @@ def right_join(left, right, key=None):
     Right join operator
     Taken from Mapping Relational Operations onto Hypergraph Model
     Modification made to remove depreciated dictionary behavior.
+    Rewritten as a hash join (see hash_join), it used to scan left once per row of right
         @param left: table (tuple) at the left side of the join
         @type left: dictionary
         @param right: table (tuple) at the right side of the join
@@ -558,24 +3323,7 @@ def right_join(left, right, key=None):
         @type key: string
         @return: joined table represented as graph
     """
-    ret = inner_join(left, right, key)
-    for k in right:
-        found = 0
-        empty = {}
-        for kk in left:
-            if left[kk][key] == k:
-                found = 1
-        if found == 0:
-            left_keys = list(left.keys())
-            left_row = left[left_keys[0]]
-            for kk in left_row:
-                if kk == key:
-                    empty[kk] = right[k]
-                else:
-                    empty[kk] = ""
-            ret[k] = empty
-            ret[k] = flatten(ret[k])
-    return ret
+    return hash_join(left, right, key, "right")
 
 
 def outer_join(left, right, key=None):
@@ -583,6 +3331,7 @@ def outer_join(left, right, key=None):
     THIS FUNCTION IS UNUSED
     Outer join operator
     Taken from Mapping Relational Operations onto Hypergraph Model
+    Rewritten as a hash join (see hash_join), it used to scan left once per row of right
         @param left: table (tuple) at the left side of the join
         @type left: dictionary
         @param right: table (tuple) at the right side of the join
@@ -591,24 +3340,7 @@ def outer_join(left, right, key=None):
         @type key: string
         @return: joined table represented as graph
     """
-    ret = left_join(left, right, key)
-    for k in right:
-        found = 0
-        empty = {}
-        for kk in left:
-            if left[kk][key] == k:
-                found = 1
-        if found == 0:
-            left_keys = left.keys()
-            left_row = left[left_keys[0]]
-            for kk in left_row:
-                if kk == key:
-                    empty[kk] = right[k]
-                else:
-                    empty[kk] = ""
-            ret[k] = empty
-            ret[k] = flatten(ret[k])
-    return ret
+    return hash_join(left, right, key, "outer")
 
 
 def cartesian(left, right, keys=None):
@@ -616,6 +3348,8 @@ def cartesian(left, right, keys=None):
     THIS FUNCTION IS UNUSED
     Cartesian (cross) join operator
     Taken from Mapping Relational Operations onto Hypergraph Model
+    Modification made to stop overwriting left's foreign key and to find the unreferenced
+    rows of right with one set instead of scanning left once per row of right
         @param left: table (tuple) at the left side of the join
         @type left: dictionary
         @param right: table (tuple) at the right side of the join
@@ -627,24 +3361,17 @@ def cartesian(left, right, keys=None):
     if not keys:
         return {}
     ret = {}
+    referenced = set()
     for left_key in left:
+        referenced.add(left[left_key][keys])
         for right_key in right:
-            new_key = left_key + "_" + right_key
-            ret[new_key] = left[left_key]
-            ret[new_key][keys] = right[right_key]
-            ret[new_key] = flatten(ret[new_key])
+            ret[f"{left_key}_{right_key}"] = joined_row(
+                left[left_key], keys, right[right_key]
+            )
     for k in right:
-        found = 0
-        # empty = {}
-        for kk in left:
-            if left[kk][keys] == k:
-                found = 1
-        if found == 0:
+        if k not in referenced:
             for kk in left:
-                key = k + "_" + kk
-                ret[key] = left[kk]
-                ret[key][keys] = right[k]
-                ret[key] = flatten(ret[key])
+                ret[f"{k}_{kk}"] = joined_row(left[kk], keys, right[k])
     return ret
 
 
@@ -653,36 +3380,25 @@ def natural_join(left, right):
     THIS FUNCTION IS NOT USED
     Natural join operator
     Taken from Mapping Relational Operations onto Hypergraph Model
+    Modification made to remove the depreciated dict.has_key function, joins with hash_join
         @param left: table (tuple) at the left side of the join
         @type left: dictionary
         @param right: table (tuple) at the right side of the join
         @type right: dictionary
         @return: joined table represented as graph
     """
-    for k in left:
-        keys1 = left[k].keys()
-        for kk in right:
-            keys2 = right[kk].keys()
-            break
-        break
+    if not left or not right:
+        return {}
+    keys1 = next(iter(left.values())).keys()
+    keys2 = next(iter(right.values())).keys()
     key = ""
     for k in keys1:
-        for kk in keys2:
-            if k == kk:
-                key = k
-                break
-        if key != "":
+        if k in keys2:
+            key = k
             break
     if key == "":
         return {}
-    ret = {}
-    for k in left:
-        if right.has_key(left[k][key]):
-            if len(right[left[k][key]]) > 0:
-                ret[k] = left[k]
-                ret[k][key] = right[left[k][key]]
-                ret[k] = flatten(ret[k])
-    return ret
+    return hash_join(left, right, key, "inner")
 
 
 def flatten(d, prefix=None, sep="."):
@@ -723,6 +3439,886 @@ def flatten(d, prefix=None, sep="."):
 
 """END MAPPING RELATIONAL OPERATIONS ONTO HYPERGRAPH SECTION"""
 
+"""Result cache"""
+
+# store name -> table name -> version, shared by every session of the store in this process
+_table_versions = {}
+# store name -> the store_state up to which _table_versions accounts for every commit
+_known_states = {}
+
+# None while the cache is disabled
+_result_cache = None
+
+
+def store_state(hypergraph, wal_path):
+    """
+    Returns the generation number of a store and the size of its write-ahead log,
+    which together change with every commit
+        @param hypergraph : the hypergraph shelve file's dictionary
+        @type hypergraph : a shelve
+        @param wal_path : the store's write-ahead log
+        @type wal_path : string
+    """
+    try:
+        size = os.path.getsize(wal_path)
+    except FileNotFoundError:
+        size = 0
+    return hypergraph.get(GENERATION_KEY, 0), size
+
+
+def table_versions(name, state):
+    """
+    Returns the committed versions of the tables of a store, shared by all of its sessions
+    in this process
+    A commit bumps the versions of the tables it changed (see HypergraphSession.publish)
+    A state this process has not accounted for means another process committed to the
+    store, and as the tables it changed are unknown every version is bumped
+    Every session works on a copy taken when it loaded, so the versions a result is tagged
+    with always describe the data it was computed from
+        @param name : the name of the shelve file
+        @type name : string
+        @param state : the state the store is in now, see store_state
+        @type state : tuple
+        @return : a dictionary of table name to version
+    """
+    versions = _table_versions.setdefault(name, {})
+    if _known_states.setdefault(name, state) != state:
+        for t in table_keys():
+            versions[t] = versions.get(t, 0) + 1
+        _known_states[name] = state
+    return versions
+
+
+class ResultCache:
+    """
+    What the read-only session methods returned, least recently used first
+    Each result is tagged with the versions of the tables it was computed from and is only
+    returned while they are unchanged. Sizes are measured as pickled bytes and the least
+    recently used results are evicted to stay within max_bytes.
+        @param max_bytes : how many bytes of results to keep
+        @type max_bytes : integer
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # (store name, method name, arguments) -> (table versions, result, size)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, versions):
+        """
+        Returns the cached result for key, or MISSING if there is none or it is stale
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            if all(versions.get(t, 0) == v for t, v in entry[0]):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.discard(key)
+        self.misses += 1
+        return MISSING
+
+    def put(self, key, tags, result):
+        """
+        Caches result for key, evicting the least recently used results to make room
+        Results larger than the whole cache are not kept
+        """
+        size = len(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        self.discard(key)
+        self.entries[key] = (tags, result, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self.discard(next(iter(self.entries)))
+            self.evictions += 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+        }
+
+
+def enable_result_cache(max_bytes=64 * 1024 * 1024):
+    """
+    Caches the results of the read-only API functions by function and arguments
+    A result is computed again once a commit changed a table it was read from
+    Results returned from the cache are shared between callers and must not be modified
+        @param max_bytes : the memory limit of the cache, in pickled bytes
+        @type max_bytes : integer
+        @default max_bytes : 64 MiB
+    """
+    global _result_cache
+    if _result_cache is None or _result_cache.max_bytes != max_bytes:
+        _result_cache = ResultCache(max_bytes)
+
+
+def disable_result_cache():
+    """
+    Drops the cached results, the read-only API functions compute every result again
+    """
+    global _result_cache
+    _result_cache = None
+
+
+def result_cache_stats():
+    """
+    Returns the hits, misses, evictions, entries and bytes of the result cache, None if disabled
+    """
+    if _result_cache is None:
+        return None
+    return _result_cache.stats()
+
+
+def cached_result(*tablenames):
+    """
+    Decorates a read-only session method whose result only depends on tablenames and its
+    arguments, so the result cache can answer it while those tables are unchanged
+    Calls with unhashable arguments are not cached, and neither are calls in a session with
+    uncommitted changes, which no other session can see
+    """
+
+    def decorate(method):
+        @wraps(method)
+        def cached(self, *args, **kwargs):
+            if _result_cache is None or self.db.dirty:
+                return method(self, *args, **kwargs)
+            key = (self.name, method.__name__, args, tuple(sorted(kwargs.items())))
+            try:
+                result = _result_cache.get(key, self.db.versions)
+            except TypeError:
+                return method(self, *args, **kwargs)
+            if result is MISSING:
+                tags = tuple((t, self.db.versions.get(t, 0)) for t in tablenames)
+                result = method(self, *args, **kwargs)
+                _result_cache.put(key, tags, result)
+            return result
+
+        return cached
+
+    return decorate
+
+
+"""Session"""
+
+
+class HypergraphSession:
+    """
+    Keeps the hypergraph shelve open and its tables loaded across API calls
+    Every module-level API function is available as a method of the same name
+    Changes stay in memory until commit() or close() is called
+    Used as a context manager, changes are committed on a clean exit and discarded on an exception
+    With wal enabled a commit appends the changed rows to a write-ahead log instead of
+    writing the shelve, and the log is folded into the shelve every checkpoint_interval
+    commits and on close. Every session replays the log when it opens, but only the session
+    owning it (see FileLock) folds it into the shelve: the session that writes it, or the first
+    session to open after a crash left it behind. Opening a second session with wal enabled
+    while the log is owned raises an exception.
+        @param name : the name of the shelve file to open
+        @type name : string
+        @default name : "hypergraph"
+        @param wal : whether commits go through the write-ahead log "<name>.wal"
+        @type wal : boolean
+        @default wal : False
+        @param group_commit_window : see WriteAheadLog
+        @type group_commit_window : number
+        @default group_commit_window : 0
+        @param checkpoint_interval : how many logged commits trigger a checkpoint
+        @type checkpoint_interval : integer
+        @default checkpoint_interval : 1000
+    """
+
+    def __init__(
+        self,
+        name="hypergraph",
+        wal=False,
+        group_commit_window=0,
+        checkpoint_interval=1000,
+    ):
+        self.name = name
+        self.wal_path = name + ".wal"
+        self.checkpoint_interval = checkpoint_interval
+        self.hypergraph = open_hypergraph(name)
+        self.wal = None
+        self.wal_lock = FileLock(self.wal_path + ".lock")
+        self.load()
+        if wal or self.logged:
+            owner = self.wal_lock.acquire()
+            if wal and not owner:
+                self.hypergraph.close()
+                self.hypergraph = None
+                raise Exception(
+                    f"The write-ahead log of {name} is in use by another session"
+                )
+            if self.logged and owner:
+                # recovery: fold what the last session logged into the shelve
+                self.checkpoint()
+        if wal:
+            self.wal = WriteAheadLog(self.wal_path, group_commit_window)
+        else:
+            self.wal_lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # nothing is flushed if the API call failed part way through,
+            # the tables only need reloading if close would checkpoint them
+            self.rollback(reload=bool(self.logged))
+        self.close()
+        return False
+
+    def load(self):
+        """
+        Loads the tables from the shelve and replays the write-ahead log on top of them
+        """
+        self.db = load_hypergraph(self.hypergraph)
+        self.db.versions = dict(table_versions(self.name, self.state()))
+        replay_wal(self.wal_path, self.db)
+        # rows that are in the log but not yet in the shelve
+        self.logged = self.db.dirty
+        self.db.dirty = {}
+        self.modified = False
+
+    def commit(self):
+        """
+        Makes the in-memory changes durable if anything changed, including the rows
+        changed by calling insert, update or delete on session.db directly and the keys
+        reserved with reserve_keys
+        Without a write-ahead log the changed rows are written to the shelve file,
+        with one they are appended to the log. The log holds rows only, a reservation
+        reaches the shelve with the next checkpoint, and after a crash the replayed rows
+        move the sequences past the keys they used (see advance_sequence)
+        """
+        if not (self.modified or self.db.dirty or self.db.sequences_dirty):
+            return
+        if self.wal is None:
+            self.write_shelve()
+        else:
+            changed = list(self.db.dirty)
+            table_versions(self.name, self.state())
+            changes = []
+            for t, primary_keys in self.db.dirty.items():
+                table = self.db[t]
+                for pk in primary_keys:
+                    changes.append((t, pk, table.get(pk)))
+                self.logged.setdefault(t, set()).update(primary_keys)
+            self.db.dirty.clear()
+            if changes:
+                self.wal.append(changes)
+                self.publish(changed)
+            if self.wal.records >= self.checkpoint_interval:
+                self.checkpoint()
+        self.modified = False
+
+    def checkpoint(self):
+        """
+        Writes the rows held only in the write-ahead log to the shelve and empties the log
+        Only the session owning the log may do this
+        """
+        if not self.wal_lock.held:
+            raise Exception(
+                f"The write-ahead log of {self.name} is owned by another session"
+            )
+        for t, primary_keys in self.logged.items():
+            self.db.dirty.setdefault(t, set()).update(primary_keys)
+        self.write_shelve()
+        self.logged = {}
+        if self.wal is not None:
+            self.wal.truncate()
+        elif os.path.exists(self.wal_path):
+            os.remove(self.wal_path)
+
+    def write_shelve(self):
+        """
+        Writes the changed rows to the shelve, which bumps its generation number
+        """
+        changed = list(self.db.dirty)
+        table_versions(self.name, self.state())
+        commit_hypergraph(self.hypergraph, self.db)
+        self.publish(changed)
+
+    def state(self):
+        """
+        The state of the store, see store_state
+        """
+        return store_state(self.hypergraph, self.wal_path)
+
+    def publish(self, tablenames):
+        """
+        Gives the tables a commit changed new versions, shared by every session of the store,
+        so the result cache no longer returns what it computed from their old rows
+        The session's tables now match the commit and take the new versions over
+        """
+        versions = _table_versions.setdefault(self.name, {})
+        for t in tablenames:
+            versions[t] = versions.get(t, 0) + 1
+        _known_states[self.name] = self.state()
+        self.db.versions = dict(versions)
+
+    def rollback(self, reload=True):
+        """
+        Discards every change made since the last commit by reloading the tables
+            @param reload : whether to read the tables again, a session about to close need not
+            @type reload : boolean
+        """
+        if reload:
+            self.load()
+        else:
+            self.db.dirty.clear()
+            self.db.sequences_dirty.clear()
+            self.modified = False
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups API calls so they take effect together: they are committed once when the
+        with block exits, and if any of them raises all of them are rolled back
+        Changes made before the block are committed when it starts
+            with session.transaction():
+                session.add_item_to_cart(userid, productid, 1)
+                orderid = session.place_order(userid, [productid])
+        """
+        self.commit()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def detach(self):
+        """
+        Reads every row into memory and closes the shelve file without committing
+        The session can still answer read-only API calls afterwards
+        """
+        materialize_hypergraph(self.db)
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+        self.wal_lock.release()
+        self.hypergraph.close()
+        self.hypergraph = None
+
+    def close(self):
+        """
+        Commits any pending changes, checkpoints the write-ahead log and closes the shelve file
+        """
+        if self.hypergraph is None:
+            return
+        self.commit()
+        if self.wal is not None:
+            if self.logged or self.db.sequences_dirty:
+                self.checkpoint()
+            self.wal.close()
+            self.wal = None
+        self.wal_lock.release()
+        self.hypergraph.close()
+        self.hypergraph = None
+
+    """Insert/delete"""
+
+    def add_item_to_cart(self, userid, productid, quantity):
+        """See add_item_to_cart"""
+        ci = generate_cart_item_val(userid, productid, quantity)
+        insert(self.db, "cart_item", (userid, productid), ci, strict=True)
+        self.modified = True
+
+    def remove_item_from_cart(self, userid, productid):
+        """See remove_item_from_cart"""
+        pk = (userid, productid)
+        delete(self.db, "cart_item", pk)
+        self.modified = True
+
+    def create_new_customer(self, cust_dict):
+        """See create_new_customer"""
+        pk = reserve_keys(self.db, "customer")
+        username = cust_dict["username"]
+        email = cust_dict["email"]
+        bill = clean_address(cust_dict["billing_address"])
+        ship = clean_address(cust_dict["shipping_address"])
+        cust = generate_customer_val(pk, email, username, ship, bill)
+        insert(self.db, "customer", pk, cust, strict=True)
+        self.modified = True
+        return pk
+
+    def delete_customer(self, userid):
+        """See delete_customer"""
+        delete(self.db, "customer", userid)
+        self.modified = True
+
+    def delete_customers(self, userids):
+        """See delete_customers"""
+        counts = delete_many(self.db, "customer", userids)
+        self.modified = True
+        return counts
+
+    def create_new_supplier(self, supp_dict):
+        """See create_new_supplier"""
+        pk = reserve_keys(self.db, "supplier")
+        supplier_name = supp_dict["supplier_name"]
+        bill = clean_address(supp_dict["billing_address"])
+        ship = clean_address(supp_dict["shipping_address"])
+        supp = generate_supplier_val(pk, supplier_name, ship, bill)
+        insert(self.db, "supplier", pk, supp, strict=True)
+        self.modified = True
+        return pk
+
+    def delete_supplier(self, supplierid):
+        """See delete_supplier"""
+        delete(self.db, "supplier", supplierid)
+        self.modified = True
+
+    def delete_suppliers(self, supplierids):
+        """See delete_suppliers"""
+        counts = delete_many(self.db, "supplier", supplierids)
+        self.modified = True
+        return counts
+
+    def add_product(self, prod_dict):
+        """See add_product"""
+        pk = reserve_keys(self.db, "product")
+        product_name = prod_dict["product_name"]
+        stock = prod_dict["stock"]
+        price = prod_dict["price"]
+        supplierid = prod_dict["supplier_id"]
+        prod = generate_product_val(pk, product_name, stock, price, supplierid)
+        insert(self.db, "product", pk, prod, strict=True)
+        self.modified = True
+        return pk
+
+    def place_order(self, userid, productlist):
+        """See place_order"""
+        db = self.db
+        """
+        whole_list = False
+        try:
+            if len(productlist) == 0:
+                whole_list = True
+        except TypeError:
+            productlist = [productlist]
+        #Find the cart items from the give userid and productid list
+        cart_item = db['cart_item']
+        product = db['product']
+        user_cart = select(cart_item,f"userid={userid}")
+        place_item = user_cart
+        if not whole_list:
+            place_item = select(user_cart,f"productid${productlist}")
+        #determine if all the ordered items are in stock
+        for pi in place_item:
+            ci = place_item[pi]
+            p = product[ci['productid']]
+            if(p['stock'] < ci['quantity']):
+                raise Exception(f"{p['product_name']} is out of stock")
+                #if not all items in stock, nothing is inserted
+        #if they are, create the order
+        """
+        missing = []
+        products = multi_get(db["product"], productlist, missing)
+        if missing:
+            raise Exception(f"Products {missing} do not exist")
+        pk = reserve_keys(db, "order")
+        new_ord = generate_order_val(pk, "placed", userid)
+        insert(db, "order", pk, new_ord, strict=True)
+        # then for each product in the order, create order contents
+        for fk, ci in products.items():
+            quantity = min(ci["stock"], random.randint(1, 5))
+            feedback = fake.sentence()
+            oc = generate_order_content_val(pk, fk, quantity, feedback)
+            insert(db, "order_content", (pk, fk), oc, strict=True)
+            # delete(db,'cart_item',(userid,fk))
+        self.modified = True
+        return pk
+
+    def pay_for_order(self, orderid, userid, value, method):
+        """See pay_for_order"""
+        db = self.db
+        order = db["order"]
+        status = order[orderid]["order_status"]
+        if status != "placed":
+            raise Exception(f"Incorrect order status: {status} should be 'placed'")
+        cost = order_total(db, orderid, userid)
+        if cost != value:
+            raise Exception(f"Payment value {value} is not equal to order cost {cost}")
+        payment = generate_payment_val(orderid, cost, method)
+        insert(db, "payment", orderid, payment, strict=True)
+        update(db, "order", orderid, {"order_status": "ordered"}, strict=True)
+        self.modified = True
+
+    def cancel_order(self, orderid, userid):
+        """See cancel_order"""
+        order = self.db["order"][orderid]
+        if order["userid"] == userid:
+            update(
+                self.db, "order", orderid, {"order_status": "cancelled"}, strict=True
+            )
+        else:
+            raise Exception(
+                f"Incorrect user, cannot cancel order {orderid} with user {userid}"
+            )
+        self.modified = True
+
+    """mass insert"""
+
+    def mass_insert_customer(self, customers):
+        """See mass_insert_customer"""
+        pk = reserve_keys(self.db, "customer", len(customers))
+        for i in range(len(customers)):
+            ship = parse_address(customers[i][2])
+            bill = parse_address(customers[i][3])
+            cust = generate_customer_val(
+                pk, customers[i][1], customers[i][0], ship, bill
+            )
+            insert(self.db, "customer", pk, cust, strict=True)
+            pk += 1
+        self.modified = True
+
+    def mass_insert_supplier(self, suppliers):
+        """See mass_insert_supplier"""
+        pk = reserve_keys(self.db, "supplier", len(suppliers))
+        for i in range(len(suppliers)):
+            ship = parse_address(suppliers[i][1])
+            bill = parse_address(suppliers[i][2])
+            supp = generate_supplier_val(pk, suppliers[i][0], ship, bill)
+            insert(self.db, "supplier", pk, supp, strict=True)
+            pk += 1
+        self.modified = True
+
+    def mass_insert_product(self, products):
+        """See mass_insert_product"""
+        pk = reserve_keys(self.db, "product", len(products))
+        for i in range(len(products)):
+            prod = generate_product_val(
+                pk, products[i][0], products[i][1], products[i][2], products[i][3]
+            )
+            insert(self.db, "product", pk, prod, strict=True)
+            pk += 1
+        self.modified = True
+
+    """updates"""
+
+    def change_product_stock(self, productid, stock):
+        """See change_product_stock"""
+        update(self.db, "product", productid, {"stock": stock}, strict=True)
+        self.modified = True
+
+    def fulfill_order(self, orderid):
+        """See fulfill_order"""
+        db = self.db
+        product = db["product"]
+        order_content = db["order_content"]
+        oc = select(order_content, f"orderid={orderid}")
+        proj = project("productid,quantity", oc)
+        for p in proj:
+            v = proj[p]
+            pid = v["productid"]
+            new_stock = product[pid]["stock"] - v["quantity"]
+            update(db, "product", pid, {"stock": new_stock}, strict=True)
+        update(db, "order", orderid, {"order_status": "shipped"}, strict=True)
+        self.modified = True
+
+    def give_order_feedback(self, userid, productid, orderid, review):
+        """See give_order_feedback"""
+        db = self.db
+        pk = (orderid, productid)
+        order = db["order"][orderid]
+        if order["order_status"] != "shipped" and order["order_status"] != "arrived":
+            raise Exception(
+                f"Order status is {order['order_status']}, order status have be arived shipped"
+            )
+        if order["userid"] == userid and pk in db["order_content"]:
+            update(db, "order_content", pk, {"feedback": review}, strict=True)
+            update(db, "order", orderid, {"order_status": "arrived"}, strict=True)
+            self.modified = True
+
+    """Searches"""
+
+    @cached_result("product", "supplier")
+    def search_product(self):
+        """See search_product"""
+        return search_product_query().run(self.db)
+
+    @cached_result("cart_item", "product")
+    def get_items_in_cart(self, userid):
+        """See get_items_in_cart"""
+        return items_in_cart_query(userid).run(self.db)
+
+    def get_cost_of_order(self, orderid, userid, verify=False):
+        """See get_cost_of_order"""
+        return order_total(self.db, orderid, userid, verify)
+
+    @cached_result("order_content", "product")
+    def get_product_feedback(self, productid):
+        """See get_product_feedback"""
+        product = self.db["product"]
+        sp = select(product, f"productid={productid}")
+        ocp = inner_join(self.db["order_content"], sp, "product_id")
+        ocp = project("feedback", ocp)
+        ret = list()
+        for v in ocp.values():
+            ret.append(v["feedback"])
+        return ret
+
+    @cached_result("order_content", "product")
+    def search_feedback(self, terms, match_all=True, supplierid=None):
+        """See search_feedback"""
+        content = self.db["order_content"]
+        keys = content.text_indexes["feedback"].search(terms, match_all)
+        if supplierid is not None:
+            products = set(child_keys(self.db, "product", "supplier", supplierid))
+            keys = [k for k in keys if k[1] in products]
+        feedback = join_rows(
+            scan(content, sorted(keys)),
+            self.db["product"],
+            "productid",
+            columns="orderid, productid, productid.product_name as product_name, "
+            "feedback",
+        )
+        return values(feedback)
+
+    @cached_result("order_content", "product")
+    def top_products_by_feedback(self, terms, k=10, match_all=True):
+        """See top_products_by_feedback"""
+        keys = (
+            self.db["order_content"].text_indexes["feedback"].search(terms, match_all)
+        )
+        # the productid of an order_content row is the second part of its key
+        matches = group_rows(
+            ((ck, {"productid": ck[1]}) for ck in keys),
+            "productid",
+            {"matches": ("count", None)},
+        )
+        top = heapq.nlargest(k, matches, key=lambda group: group[1]["matches"])
+        top = join_rows(
+            top,
+            self.db["product"],
+            "productid",
+            columns="productid, productid.product_name as product_name, matches",
+        )
+        return values(top)
+
+    @cached_result("product")
+    def get_products_by_price(self, low=None, high=None, descending=False):
+        """See get_products_by_price"""
+        products = ordered_rows(self.db["product"], "price", low, high, descending)
+        return values(project_rows(products, "productid, product_name, price, stock"))
+
+    @cached_result("order_content", "product")
+    def get_all_product_feedback(self):
+        """See get_all_product_feedback"""
+        content = self.db["order_content"]
+        product = self.db["product"]
+        feedback = group_by(content, "productid", {"feedback": ("list", "feedback")})
+        ret = []
+        for pid, row in scan(product):
+            ret.append(
+                {
+                    "productid": row["productid"],
+                    "product_name": row["product_name"],
+                    "feedback": feedback[pid]["feedback"] if pid in feedback else [],
+                }
+            )
+        return ret
+
+    @cached_result("order_content", "product", "supplier")
+    def get_revenue_per_supplier(self):
+        """See get_revenue_per_supplier"""
+        sales = join_rows(
+            scan(self.db["order_content"]),
+            self.db["product"],
+            "productid",
+            columns="productid.supplierid as supplierid, productid.price as price, "
+            "quantity",
+        )
+        revenue = group_rows(
+            sales,
+            "supplierid",
+            {"revenue": ("sum", lambda row: row["price"] * row["quantity"])},
+        )
+        revenue = join_rows(
+            revenue,
+            self.db["supplier"],
+            "supplierid",
+            columns="supplierid, supplierid.supplier_name as supplier_name, revenue",
+        )
+        return values(revenue)
+
+    @cached_result("order_content", "product")
+    def get_units_sold_per_product(self):
+        """See get_units_sold_per_product"""
+        units = group_rows(
+            scan(self.db["order_content"]),
+            "productid",
+            {"units_sold": ("sum", "quantity")},
+        )
+        units = join_rows(
+            units,
+            self.db["product"],
+            "productid",
+            columns="productid, productid.product_name as product_name, units_sold",
+        )
+        return values(units)
+
+    @cached_result("customer")
+    def get_customer(self, username):
+        """See get_customer"""
+        c = select(self.db["customer"], f"username={username}")
+        return list(c.values())
+
+    @cached_result("supplier")
+    def get_supplier(self, supplier_name):
+        """See get_supplier"""
+        s = select(self.db["supplier"], f"supplier_name={supplier_name}")
+        return list(s.values())
+
+    @cached_result("product")
+    def get_product(self, product_name):
+        """See get_product"""
+        p = select(self.db["product"], f"product_name={product_name}")
+        return list(p.values())
+
+    @cached_result("order", "order_content", "product")
+    def get_orders(self, userid):
+        """See get_orders"""
+        return orders_query(userid).run(self.db)
+
+    def username_by_id(self, uid):
+        """See username_by_id"""
+        return self.db["customer"][uid]["username"]
+
+    def supplier_name_by_id(self, sid):
+        """See supplier_name_by_id"""
+        return self.db["supplier"][sid]["supplier_name"]
+
+    def product_name_by_id(self, pid):
+        """See product_name_by_id"""
+        return self.db["product"][pid]["product_name"]
+
+    def get_rows_by_key(self, tablename, primary_keys, missing=None):
+        """See get_rows_by_key"""
+        return list(multi_get(self.db[tablename], primary_keys, missing).values())
+
+    def explain(self, query, analyze=False):
+        """See explain"""
+        return query.explain(self.db, analyze)
+
+
+"""Read cache"""
+
+# store name -> [file signature, generation, detached HypergraphSession]
+# None while the cache is disabled
+_read_cache = None
+
+
+def enable_read_cache():
+    """
+    Keeps the tables loaded by read-only API functions in memory between calls
+    Each call only checks the modification times of the shelve's files, and if they changed,
+    its generation number. The tables are reloaded when a commit has changed the generation.
+    Rows returned by the read-only functions are shared with the cache and must not be modified
+    """
+    global _read_cache
+    if _read_cache is None:
+        _read_cache = {}
+
+
+def disable_read_cache():
+    """
+    Drops the cached tables, read-only API functions load the shelve on every call again
+    """
+    global _read_cache
+    _read_cache = None
+
+
+def store_signature(name):
+    """
+    Returns the modification times and sizes of the files a shelve and its write-ahead log use
+    The files depend on how the store is kept (see open_hypergraph), so every known suffix is checked
+        @param name : the name of the shelve file
+        @type name : string
+        @return : a tuple that changes whenever one of the files is written
+    """
+    signature = []
+    for suffix in (".sqlite", "", ".db", ".dat", ".dir", ".pag", ".wal"):
+        try:
+            st = os.stat(name + suffix)
+        except FileNotFoundError:
+            continue
+        signature.append((suffix, st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+
+@contextmanager
+def read_session(name="hypergraph"):
+    """
+    Provides a session for a read-only API call
+    With the read cache enabled this is the cached session of the store, reloaded only if
+    the store's generation number changed or a write-ahead log is waiting to be replayed
+    The shelve is not opened at all while its files are untouched
+        @param name : the name of the shelve file to read
+        @type name : string
+        @default name : "hypergraph"
+    """
+    if _read_cache is None:
+        with HypergraphSession(name) as session:
+            yield session
+        return
+    signature = store_signature(name)
+    cached = _read_cache.get(name)
+    if cached is not None and cached[0] == signature:
+        yield cached[2]
+        return
+    hypergraph = open_hypergraph(name, "r")
+    generation = hypergraph.get(GENERATION_KEY, 0)
+    hypergraph.close()
+    wal_pending = os.path.exists(name + ".wal") and os.path.getsize(name + ".wal") > 0
+    if cached is None or cached[1] != generation or wal_pending:
+        session = HypergraphSession(name)
+        # opening may have folded a write-ahead log into the shelve
+        generation = session.hypergraph.get(GENERATION_KEY, 0)
+        session.detach()
+        cached = [None, generation, session]
+        _read_cache[name] = cached
+    cached[0] = store_signature(name)
+    yield cached[2]
+
+
+@contextmanager
+def transaction(name="hypergraph", wal=False):
+    """
+    Provides a session whose API calls take effect together, see HypergraphSession.transaction
+    The shelve is opened and committed once for all of them, instead of once per module-level call
+        with transaction() as session:
+            session.add_item_to_cart(userid, productid, 1)
+            orderid = session.place_order(userid, [productid])
+            cost = session.get_cost_of_order(orderid, userid)
+            session.pay_for_order(orderid, userid, cost, "card")
+        @param name : the name of the shelve file to open
+        @type name : string
+        @default name : "hypergraph"
+        @param wal : whether the commit goes through the write-ahead log, see HypergraphSession
+        @type wal : boolean
+        @default wal : False
+    """
+    with HypergraphSession(name, wal) as session:
+        with session.transaction():
+            yield session
+
+
 """Insert/delete"""
 
 
@@ -735,15 +4331,10 @@ def add_item_to_cart(userid, productid, quantity):
         @type productid : integer
         @param quantity : How many of the item are being added to the cart
         @type quantity : integer
+        @raise Exception : if the user or the product does not exist, nothing is added
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    ci = generate_cart_item_val(userid, productid, quantity)
-    insert(db, "cart_item", (userid, productid), ci)
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+    with HypergraphSession() as session:
+        return session.add_item_to_cart(userid, productid, quantity)
 
 
 def remove_item_from_cart(userid, productid):
@@ -754,14 +4345,8 @@ def remove_item_from_cart(userid, productid):
         @param productid : The id of the product being removed from the cart
         @type productid : integer
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    pk = (userid, productid)
-    delete(db, "cart_item", pk)
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+    with HypergraphSession() as session:
+        return session.remove_item_from_cart(userid, productid)
 
 
 def create_new_customer(cust_dict):
@@ -771,23 +4356,8 @@ def create_new_customer(cust_dict):
         @type cust_dict: a dictionary with dictionaries for addresses
         @return : new customer's userid as integer
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    customer = db["customer"]
-    pk = 1
-    if len(customer) > 0:
-        pk = max(customer.keys()) + 1
-    username = cust_dict["username"]
-    email = cust_dict["email"]
-    bill = clean_address(cust_dict["billing_address"])
-    ship = clean_address(cust_dict["shipping_address"])
-    cust = generate_customer_val(pk, email, username, ship, bill)
-    insert(db, "customer", pk, cust)
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
-    return pk
+    with HypergraphSession() as session:
+        return session.create_new_customer(cust_dict)
 
 
 def delete_customer(userid):
@@ -796,13 +4366,20 @@ def delete_customer(userid):
         @param userid : the userid of the customer to delete
         @type userid : integer
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
+    with HypergraphSession() as session:
+        return session.delete_customer(userid)
 
-    delete(db, "customer", userid)
 
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+def delete_customers(userids):
+    """
+    Deletes many customers at once, cascading like delete_customer
+    Userids without a customer are skipped
+        @param userids : the userids of the customers to delete
+        @type userids : iterable of integers
+        @return : how many rows were deleted from each table, as a dictionary of table name to count
+    """
+    with HypergraphSession() as session:
+        return session.delete_customers(userids)
 
 
 def create_new_supplier(supp_dict):
@@ -812,22 +4389,8 @@ def create_new_supplier(supp_dict):
         @type supp_dict: a dictionary with dictionaries for addresses
         @return : new supplier's supplierid ad integer
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    supplier = db["supplier"]
-    pk = 1
-    if len(supplier) > 0:
-        pk = max(supplier.keys()) + 1
-    supplier_name = supp_dict["supplier_name"]
-    bill = clean_address(supp_dict["billing_address"])
-    ship = clean_address(supp_dict["shipping_address"])
-    supp = generate_supplier_val(pk, supplier_name, ship, bill)
-    insert(db, "supplier", pk, supp)
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
-    return pk
+    with HypergraphSession() as session:
+        return session.create_new_supplier(supp_dict)
 
 
 def delete_supplier(supplierid):
@@ -836,13 +4399,20 @@ def delete_supplier(supplierid):
         @param supplierid : the id of the supplier to delete
         @type supplierid : integer
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
+    with HypergraphSession() as session:
+        return session.delete_supplier(supplierid)
 
-    delete(db, "supplier", supplierid)
 
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+def delete_suppliers(supplierids):
+    """
+    Deletes many suppliers at once, cascading like delete_supplier
+    Supplierids without a supplier are skipped
+        @param supplierids : the ids of the suppliers to delete
+        @type supplierids : iterable of integers
+        @return : how many rows were deleted from each table, as a dictionary of table name to count
+    """
+    with HypergraphSession() as session:
+        return session.delete_suppliers(supplierids)
 
 
 def add_product(prod_dict):
@@ -857,24 +4427,10 @@ def add_product(prod_dict):
         @param supplierid : the id of the supplier of this product
         @type supplierid : integer
         @return new product's productid as integer
+        @raise Exception : if the supplier does not exist, nothing is added
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    product = db["product"]
-    pk = 1
-    if len(product) > 0:
-        pk = max(product.keys()) + 1
-    product_name = prod_dict["product_name"]
-    stock = prod_dict["stock"]
-    price = prod_dict["price"]
-    supplierid = prod_dict["supplier_id"]
-    prod = generate_product_val(pk, product_name, stock, price, supplierid)
-    insert(db, "product", pk, prod)
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
-    return pk
+    with HypergraphSession() as session:
+        return session.add_product(prod_dict)
 
 
 def place_order(userid, productlist):
@@ -888,53 +4444,10 @@ def place_order(userid, productlist):
         @param productlist : the list of products the user is ordering.
         @type productlist : array of integers OR a singleton integer
         @return : the order's orderid as an integer
+        @raise Exception : if the user or one of the products does not exist, no order is placed
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    """
-    whole_list = False
-    try:
-        if len(productlist) == 0:
-            whole_list = True
-    except TypeError:
-        productlist = [productlist]
-    #Find the cart items from the give userid and productid list
-    cart_item = db['cart_item']
-    product = db['product']
-    user_cart = select(cart_item,f"userid={userid}")
-    place_item = user_cart
-    if not whole_list:
-        place_item = select(user_cart,f"productid${productlist}")
-    #determine if all the ordered items are in stock
-    for pi in place_item:
-        ci = place_item[pi]
-        p = product[ci['productid']]
-        if(p['stock'] < ci['quantity']):
-            hypergraph.close()
-            raise Exception(f"{p['product_name']} is out of stock")
-            #if not all items in stock, nothing is inserted
-    #if they are, create the order
-    """
-    order = db["order"]
-    product = db["product"]
-    pk = 1
-    if len(order) > 0:
-        pk = max(order.keys()) + 1
-    new_ord = generate_order_val(pk, "placed", userid)
-    insert(db, "order", pk, new_ord)
-    # then for each product in the order, create order contents
-    for fk in productlist:
-        ci = product[fk]
-        quantity = min(ci["stock"], random.randint(1, 5))
-        feedback = fake.sentence()
-        oc = generate_order_content_val(pk, fk, quantity, feedback)
-        insert(db, "order_content", (pk, fk), oc)
-        # delete(db,'cart_item',(userid,fk))
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
-    return pk
+    with HypergraphSession() as session:
+        return session.place_order(userid, productlist)
 
 
 def pay_for_order(orderid, userid, value, method):
@@ -952,28 +4465,8 @@ def pay_for_order(orderid, userid, value, method):
         @raise Exception: If user did not place this order
         @raise Exception: if value is not equal to the order's cost
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    order = db["order"]
-    status = order[orderid]["order_status"]
-    if status != "placed":
-        hypergraph.close()
-        raise Exception(f"Incorrect order status: {status} should be 'placed'")
-    try:
-        cost = calc_cost(db, orderid, userid)
-    except Exception as err:
-        hypergraph.close()
-        raise err
-    if cost != value:
-        hypergraph.close()
-        raise Exception(f"Payment value {value} is not equal to order cost {cost}")
-    payment = generate_payment_val(orderid, cost, method)
-    insert(db, "payment", orderid, payment)
-    update(db, "order", orderid, {"order_status": "ordered"})
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+    with HypergraphSession() as session:
+        return session.pay_for_order(orderid, userid, value, method)
 
 
 def cancel_order(orderid, userid):
@@ -985,19 +4478,8 @@ def cancel_order(orderid, userid):
         @type userid : integer
         @raise Exception : if the user did not place the order
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    order = db["order"][orderid]
-    if order["userid"] == userid:
-        update(db, "order", orderid, {"order_status": "cancelled"})
-    else:
-        raise Exception(
-            f"Incorrect user, cannot cancel order {orderid} with user {userid}"
-        )
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+    with HypergraphSession() as session:
+        return session.cancel_order(orderid, userid)
 
 
 """mass insert"""
@@ -1013,22 +4495,8 @@ def mass_insert_customer(customers):
             2:formatted string:shipping_address
             3:formatted stringbilling_address
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    customer = db["customer"]
-    pk = 1
-    if len(customer) > 0:
-        pk = max(customer.keys()) + 1
-    for i in range(len(customers)):
-        ship = parse_address(customers[i][2])
-        bill = parse_address(customers[i][3])
-        cust = generate_customer_val(pk, customers[i][1], customers[i][0], ship, bill)
-        insert(db, "customer", pk, cust)
-        pk += 1
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+    with HypergraphSession() as session:
+        return session.mass_insert_customer(customers)
 
 
 def mass_insert_supplier(suppliers):
@@ -1040,22 +4508,8 @@ def mass_insert_supplier(suppliers):
         1:formatted string: shipping_address
         2:formatted string: billing_address
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    supplier = db["supplier"]
-    pk = 1
-    if len(supplier) > 0:
-        pk = max(supplier.keys()) + 1
-    for i in range(len(suppliers)):
-        ship = parse_address(suppliers[i][1])
-        bill = parse_address(suppliers[i][2])
-        supp = generate_supplier_val(pk, suppliers[i][0], ship, bill)
-        insert(db, "supplier", pk, supp)
-        pk += 1
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+    with HypergraphSession() as session:
+        return session.mass_insert_supplier(suppliers)
 
 
 def mass_insert_product(products):
@@ -1067,23 +4521,10 @@ def mass_insert_product(products):
             1:integer: stock
             2:number: price
             3:integer: supplierid
+        @raise Exception : if a product's supplier does not exist, none of the products are inserted
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    product = db["product"]
-    pk = 1
-    if len(product) > 0:
-        pk = max(product.keys()) + 1
-    for i in range(len(products)):
-        prod = generate_product_val(
-            pk, products[i][0], products[i][1], products[i][2], products[i][3]
-        )
-        insert(db, "product", pk, prod)
-        pk += 1
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+    with HypergraphSession() as session:
+        return session.mass_insert_product(products)
 
 
 """updates"""
@@ -1097,13 +4538,8 @@ def change_product_stock(productid, stock):
         @param stock : the number to change the product's stock to
         @type stock : integer
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    update(db, "product", productid, {"stock": stock})
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+    with HypergraphSession() as session:
+        return session.change_product_stock(productid, stock)
 
 
 def fulfill_order(orderid):
@@ -1114,22 +4550,8 @@ def fulfill_order(orderid):
         @param orderid : the order to fulfill
         @type orderid : integer
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    product = db["product"]
-    order_content = db["order_content"]
-    oc = select(order_content, f"orderid={orderid}")
-    proj = project("productid,quantity", oc)
-    for p in proj:
-        v = proj[p]
-        pid = v["productid"]
-        new_stock = product[pid]["stock"] - v["quantity"]
-        update(db, "product", pid, {"stock": new_stock})
-    update(db, "order", orderid, {"order_status": "shipped"})
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+    with HypergraphSession() as session:
+        return session.fulfill_order(orderid)
 
 
 def give_order_feedback(userid, productid, orderid, review):
@@ -1147,21 +4569,8 @@ def give_order_feedback(userid, productid, orderid, review):
         @type review : string
         @raise Exception : if the order status is not shipped
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-
-    pk = (orderid, productid)
-    order = db["order"][orderid]
-    if order["order_status"] != "shipped" and order["order_status"] != "arrived":
-        raise Exception(
-            f"Order status is {order['order_status']}, order status have be arived shipped"
-        )
-    if order["userid"] == userid and pk in db["order_content"]:
-        update(db, "order_content", pk, {"feedback": review})
-        update(db, "order", orderid, {"order_status": "arrived"})
-
-    commit_hypergraph(hypergraph, db)
-    hypergraph.close()
+    with HypergraphSession() as session:
+        return session.give_order_feedback(userid, productid, orderid, review)
 
 
 """Searches"""
@@ -1170,20 +4579,15 @@ def give_order_feedback(userid, productid, orderid, review):
 def search_product():
     """
     Gets all products with available stock
+    The products are read from the in_stock_products view, which lives in the memory of a
+    session and is built by its first read. A call without the read cache opens a new session
+    and builds the view again, as does the first call after every commit with it, so reads
+    of a ready list need a long-lived HypergraphSession or the read cache between commits
         @return : a list of dictionaries with the product information.
         Keys : {productid, product_name, price, stock, supplier_name}
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
-
-    product = db["product"]
-    supplier = db["supplier"]
-    in_stock = select(product, "stock > 0")
-    products_and_suppliers = inner_join(in_stock, supplier, "supplierid")
-    pas = rename(products_and_suppliers, "supplierid.supplier_name", "supplier_name")
-    proj = project("productid,product_name,price,stock,supplier_name", pas)
-    return list(proj.values())
+    with read_session() as session:
+        return session.search_product()
 
 
 def get_items_in_cart(userid):
@@ -1194,36 +4598,26 @@ def get_items_in_cart(userid):
         @return : a list of dictionaries with the product and cart information
         Keys : {productid, product_name, price, quantity}
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
-
-    cart_item = db["cart_item"]
-    product = db["product"]
-    ci = select(cart_item, f"userid={userid}")
-    cip = inner_join(ci, product, "productid")
-    cip = rename(cip, "productid.productid", "productid")
-    cip = rename(cip, "productid.product_name", "product_name")
-    cip = rename(cip, "productid.price", "price")
-    cip = project("productid,product_name,price,quantity", cip)
-    return list(cip.values())
+    with read_session() as session:
+        return session.get_items_in_cart(userid)
 
 
-def get_cost_of_order(orderid, userid):
+def get_cost_of_order(orderid, userid, verify=False):
     """
     Returns the total cost of the order.
     Total cost is SUM(quantity*price) on each product ordered.
+    It is kept up to date as the order's contents and products change, so this is a lookup
         @param orderid : the order to calculate the cost of
         @type orderid : integer
         @param userid : the user who placed the order
         @type userid : integer
-        @raise Exception : if the user did not place the order
+        @param verify : whether to cross-check the kept total against the full computation
+        @type verify : boolean
+        @raise Exception : if the user did not place the order, or verify found a mismatch
         @return : the cost of the order as a number
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
-    return calc_cost(db, orderid, userid)
+    with read_session() as session:
+        return session.get_cost_of_order(orderid, userid, verify)
 
 
 def get_product_feedback(productid):
@@ -1233,18 +4627,8 @@ def get_product_feedback(productid):
         @type productid : integer
         @return a list of reviews as strings
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
-
-    product = db["product"]
-    sp = select(product, f"productid={productid}")
-    ocp = inner_join(db["order_content"], sp, "product_id")
-    ocp = project("feedback", ocp)
-    ret = list()
-    for v in ocp.values():
-        ret.append(v["feedback"])
-    return ret
+    with read_session() as session:
+        return session.get_product_feedback(productid)
 
 
 def get_all_product_feedback():
@@ -1252,22 +4636,79 @@ def get_all_product_feedback():
     Get the feedback for every product
         @return : a list of dictionaries with the product names and feedback
         Keys : {productid, product_name,feedback}
+        feedback is the list of the product's feedback, empty if nobody ordered it
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
+    with read_session() as session:
+        return session.get_all_product_feedback()
 
-    content = db["order_content"]
-    product = db["product"]
-    pf = right_join(content, product, "productid")
-    # for pid in product:
-    #     oc = select(content, f"productid={pid}")
-    #     all_feedback = list()
-    #     for ocid in oc:
-    #         all_feedback.append(content[ocid]["feedback"])
-    #     pf[pid]["feedback"] = all_feedback
-    pf = project("productid,product_name,feedback", pf)
-    return list(pf.values())
+
+def search_feedback(terms, match_all=True, supplierid=None):
+    """
+    Finds the feedback mentioning some words, through the inverted index of feedback
+        @param terms : the words to look for, case is ignored
+        @type terms : string
+        @param match_all : True for feedback with every word, False for feedback with any of them
+        @type match_all : boolean
+        @param supplierid : only search the feedback of this supplier's products, if given
+        @type supplierid : integer
+        @return : a list of dictionaries
+        Keys : {orderid,productid,product_name,feedback}
+    """
+    with read_session() as session:
+        return session.search_feedback(terms, match_all, supplierid)
+
+
+def top_products_by_feedback(terms, k=10, match_all=True):
+    """
+    Gets the k products with the most feedback mentioning some words, most first
+        @param terms : the words to look for, see search_feedback
+        @type terms : string
+        @param k : how many products to return
+        @type k : integer
+        @param match_all : True for feedback with every word, False for feedback with any of them
+        @type match_all : boolean
+        @return : a list of dictionaries
+        Keys : {productid,product_name,matches}
+    """
+    with read_session() as session:
+        return session.top_products_by_feedback(terms, k, match_all)
+
+
+def get_products_by_price(low=None, high=None, descending=False):
+    """
+    Gets the products priced between low and high, cheapest first
+        @param low : the lowest price, None for no lower bound
+        @type low : number
+        @param high : the highest price, None for no upper bound
+        @type high : number
+        @param descending : True for the most expensive first
+        @type descending : boolean
+        @return : a list of dictionaries
+        Keys : {productid,product_name,price,stock}
+    """
+    with read_session() as session:
+        return session.get_products_by_price(low, high, descending)
+
+
+def get_revenue_per_supplier():
+    """
+    Gets the revenue of every supplier with orders, the price times the quantity
+    of everything ordered from them
+        @return : a list of dictionaries
+        Keys : {supplierid,supplier_name,revenue}
+    """
+    with read_session() as session:
+        return session.get_revenue_per_supplier()
+
+
+def get_units_sold_per_product():
+    """
+    Gets how many units of every ordered product were ordered
+        @return : a list of dictionaries
+        Keys : {productid,product_name,units_sold}
+    """
+    with read_session() as session:
+        return session.get_units_sold_per_product()
 
 
 def get_customer(username):
@@ -1278,13 +4719,8 @@ def get_customer(username):
         @return : a list of dictionaries representing the customers with that username (should be size 1)
         Keys : {userid, username, email, shipping_address, billing_address}
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
-
-    customer = db["customer"]
-    c = select(customer, f"username={username}")
-    return list(c.values())
+    with read_session() as session:
+        return session.get_customer(username)
 
 
 def get_supplier(supplier_name):
@@ -1295,13 +4731,8 @@ def get_supplier(supplier_name):
         @return a list of dictionaries representing the suppliers with that supplier_name (should be size 1)
         Keys : {supplierid, supplier_name, shipping_address, billing_address}
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
-
-    supplier = db["supplier"]
-    s = select(supplier, f"supplier_name={supplier_name}")
-    return list(s.values())
+    with read_session() as session:
+        return session.get_supplier(supplier_name)
 
 
 def get_product(product_name):
@@ -1312,13 +4743,8 @@ def get_product(product_name):
         @return a list of dictionary representing the products with that product_name
         Keys : {productid,product_name,stock,price,supplierid}
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
-
-    product = db["product"]
-    p = select(product, f"product_name={product_name}")
-    return list(p.values())
+    with read_session() as session:
+        return session.get_product(product_name)
 
 
 def get_orders(userid):
@@ -1329,57 +4755,52 @@ def get_orders(userid):
         @return : a list of dictionaries containing the order information
         Keys : {productid,product_name,price,quantity,orderid,order_status}
     """
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
-
-    order = db["order"]
-    order_content = db["order_content"]
-    product = db["product"]
-    o = select(order, f"userid={userid}")
-    orderids = list(o.keys())
-    # get order contents for each order
-    oc = select(order_content, f"orderid${orderids}")
-    # get product details for each order contents
-    ocp = inner_join(oc, product, "productid")
-    # rename to remove flattening dots
-    ocp = rename(ocp, "productid.productid", "productid")
-    ocp = rename(ocp, "productid.product_name", "product_name")
-    ocp = rename(ocp, "productid.price", "price")
-    # remove extra fields
-    ocp = project("orderid,productid,product_name,price,quantity", ocp)
-    # don't need userid anymore
-    o = project("orderid,order_status", o)
-    # join to get order status
-    user_orders = inner_join(ocp, o, "orderid")
-    # rename flattening dots
-    uo = rename(user_orders, "orderid.orderid", "orderid")
-    uo = rename(uo, "orderid.order_status", "order_status")
-    return list(uo.values())
+    with read_session() as session:
+        return session.get_orders(userid)
 
 
 def username_by_id(uid):
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
-
-    return db["customer"][uid]["username"]
+    with read_session() as session:
+        return session.username_by_id(uid)
 
 
 def supplier_name_by_id(sid):
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
-
-    return db["supplier"][sid]["supplier_name"]
+    with read_session() as session:
+        return session.supplier_name_by_id(sid)
 
 
 def product_name_by_id(pid):
-    hypergraph = shelve.open("hypergraph")
-    db = load_hypergraph(hypergraph)
-    hypergraph.close()
+    with read_session() as session:
+        return session.product_name_by_id(pid)
+
+
+def get_rows_by_key(tablename, primary_keys, missing=None):
+    """
+    Gets many rows of a table by their primary keys at once
+        @param tablename : the table to read
+        @type tablename : string
+        @param primary_keys : the primary keys of the rows
+        @type primary_keys : an iterable of primary keys
+        @param missing : if given, the primary keys that are not in the table are appended to it
+        @type missing : list
+        @return : a list of dictionaries, in the order of primary_keys
+    """
+    with read_session() as session:
+        return session.get_rows_by_key(tablename, primary_keys, missing)
+
 
-    return db["product"][pid]["product_name"]
+def explain(query, analyze=False):
+    """
+    Describes how a query runs, e.g. explain(orders_query(userid), analyze=True)
+        @param query : the query to explain, see the queries section for the searches' ones
+        @type query : Query or ViewQuery
+        @param analyze : whether to run the query and report the actual rows in, rows out and
+            time of each operator, and whether it used an index or a full scan
+        @type analyze : boolean
+        @return : the operator tree of the query's plan, the last operator on top
+    """
+    with read_session() as session:
+        return session.explain(query, analyze)
 
 
 """THIS FUNCTION CLEARS THE HYPERGRAPH"""
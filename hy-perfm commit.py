@@ -0,0 +1,124 @@
+import os
+import random
+import shelve
+import tempfile
+import time
+import Hypergraph
+
+
+def bytes_written():
+    """The bytes this process has passed to write() so far, None without /proc/self/io."""
+    try:
+        with open("/proc/self/io") as io:
+            for line in io:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def address(i):
+    """Generate a parseable address string."""
+    return f"{i} Main St Springfield, IL 62701 USA"
+
+
+def build_store(name, layout, num_rows):
+    """Create a store with num_rows customers, suppliers, products and orders."""
+    Hypergraph.init_hypergraph(name, layout)
+    with Hypergraph.HypergraphSession(name) as session:
+        session.mass_insert_customer(
+            [
+                [f"user{i}", f"user{i}@mail.com", address(i), address(i)]
+                for i in range(num_rows)
+            ]
+        )
+        session.mass_insert_supplier(
+            [[f"supplier{i}", address(i), address(i)] for i in range(num_rows)]
+        )
+        session.mass_insert_product(
+            [
+                [f"product{i}", 100, i % 50 + 1, i % num_rows + 1]
+                for i in range(num_rows)
+            ]
+        )
+        for userid in range(1, num_rows + 1):
+            session.add_item_to_cart(userid, userid, 1)
+            session.place_order(userid, [userid, num_rows + 1 - userid])
+
+
+def api_calls(num_rows):
+    """The mutating API calls to measure, as (label, method name, arguments)."""
+    userid = random.randint(1, num_rows)
+    return [
+        ("add_item_to_cart", "add_item_to_cart", (userid, num_rows, 2)),
+        ("remove_item_from_cart", "remove_item_from_cart", (userid, userid)),
+        ("change_product_stock", "change_product_stock", (userid, 42)),
+        ("place_order", "place_order", (userid, [1, 2])),
+        ("cancel_order", "cancel_order", (userid, userid)),
+        ("fulfill_order", "fulfill_order", (userid,)),
+    ]
+
+
+def write_tables(hypergraph, db):
+    """Write every table as one pickled dictionary, as commit_hypergraph did at first."""
+    for t in Hypergraph.table_keys():
+        hypergraph[t] = dict(db[t])
+    hypergraph.sync()
+
+
+def measure_commit(name, method, args, full_commit):
+    """
+    Run one API call in its own session and return the seconds and bytes its commit
+    takes, bytes are None where they cannot be measured.
+    A full commit rewrites every table of a shelve.open store holding one key per table,
+    which is what committing cost before commits only wrote what changed.
+    """
+    with Hypergraph.HypergraphSession(name) as session:
+        getattr(session, method)(*args)
+        if full_commit:
+            Hypergraph.materialize_hypergraph(session.db)
+            hypergraph = shelve.open(name + "_before")
+        before = bytes_written()
+        start = time.perf_counter()
+        if full_commit:
+            write_tables(hypergraph, session.db)
+        else:
+            session.commit()
+        seconds = time.perf_counter() - start
+        after = bytes_written()
+        if full_commit:
+            hypergraph.close()
+            session.rollback(reload=False)
+    return seconds, None if before is None else after - before
+
+
+def show(seconds, written):
+    """Format a measurement as milliseconds and kilobytes."""
+    kilobytes = "n/a" if written is None else f"{written / 1024:.1f}"
+    return f"{seconds * 1000:>10.1f}{kilobytes:>10}"
+
+
+if __name__ == "__main__":
+    num_rows = 1000
+    directory = tempfile.mkdtemp()
+    full_store = os.path.join(directory, "full_commit")
+    table_store = os.path.join(directory, "table_layout")
+    row_store = os.path.join(directory, "row_layout")
+    build_store(full_store, Hypergraph.TABLE_LAYOUT, num_rows)
+    with Hypergraph.HypergraphSession(full_store) as session:
+        Hypergraph.materialize_hypergraph(session.db)
+        hypergraph = shelve.open(full_store + "_before")
+        write_tables(hypergraph, session.db)
+        hypergraph.close()
+    build_store(table_store, Hypergraph.TABLE_LAYOUT, num_rows)
+    build_store(row_store, Hypergraph.ROW_LAYOUT, num_rows)
+
+    print(f"\nCommit of one API call, ms and KB written ({num_rows} rows per table):")
+    header = ["before", "dirty tables", "dirty rows"]
+    print(f"{'call':<24}" + "".join(f"{h:>20}" for h in header))
+    for label, method, args in api_calls(num_rows):
+        before = measure_commit(full_store, method, args, True)
+        tables = measure_commit(table_store, method, args, False)
+        rows = measure_commit(row_store, method, args, False)
+        print(f"{label:<24}{show(*before)}{show(*tables)}{show(*rows)}")
@@ -396,7 +396,21 @@ def measure_add_product_performance(product_id_base, product_name_base, num_quer
     )
 
 
+def print_query_plans(customer_id):
+    """Print EXPLAIN ANALYZE of the planned searches, to see which indexes they use."""
+    for label, query in [
+        ("Get Orders", Hypergraph.orders_query(customer_id)),
+        ("Items In Cart", Hypergraph.items_in_cart_query(customer_id)),
+        ("Search Product", Hypergraph.search_product_query()),
+    ]:
+        print(f"\n{label}:")
+        print(Hypergraph.explain(query, analyze=True))
+
+
 if __name__ == "__main__":
+    # keep the tables in memory between queries so the loops time the queries
+    # rather than reloading the shelve
+    Hypergraph.enable_read_cache()
     # Test parameters
     num_queries = 1000
     test_customer_id = random.randint(1, 1000)
@@ -412,6 +426,8 @@ if __name__ == "__main__":
     base_supplier_id = random.randint(1, 1000)
     base_product_id, base_product_name = random.randint(1, 1000), "TEST_PRODUCT_NAME"
 
+    print_query_plans(test_customer_id)
+
     print("\nQuery Performance Test Results:")
     measure_get_orders_performance(num_queries, test_customer_id)
     measure_product_search_performance(num_queries, test_product_name)
@@ -0,0 +1,189 @@
+"""
+Regression tests of the Hypergraph sessions, run with pytest
+"""
+
+import os
+import subprocess
+import sys
+import time
+import pytest
+import Hypergraph
+
+ADDRESS = "1 Main St Springfield, IL 62701 USA"
+
+
+@pytest.fixture(params=[Hypergraph.ROW_LAYOUT, Hypergraph.TABLE_LAYOUT])
+def store(request, tmp_path):
+    """A store with two customers, suppliers and products, and an order of each customer."""
+    name = str(tmp_path / "hypergraph")
+    Hypergraph.init_hypergraph(name, request.param)
+    with Hypergraph.HypergraphSession(name) as session:
+        session.mass_insert_customer(
+            [[f"user{i}", f"user{i}@mail.com", ADDRESS, ADDRESS] for i in range(2)]
+        )
+        session.mass_insert_supplier(
+            [[f"supplier{i}", ADDRESS, ADDRESS] for i in range(2)]
+        )
+        session.mass_insert_product([[f"product{i}", 5, 2, i + 1] for i in range(2)])
+        for userid in (1, 2):
+            session.add_item_to_cart(userid, 1, 1)
+            session.place_order(userid, [1, 2])
+    return name
+
+
+def crash(name, code):
+    """
+    Runs code in a new process with session, a write-ahead log session of the store,
+    and kills the process before the session is closed
+    """
+    script = (
+        "import os\n"
+        "import Hypergraph\n"
+        f"session = Hypergraph.HypergraphSession({name!r}, wal=True)\n"
+        f"{code}\n"
+        "os._exit(0)\n"
+    )
+    package = os.path.dirname(os.path.abspath(Hypergraph.__file__))
+    subprocess.run([sys.executable, "-c", script], cwd=package, check=True)
+
+
+def stock(name, productid):
+    with Hypergraph.HypergraphSession(name) as session:
+        return session.db["product"][productid]["stock"]
+
+
+def test_wal_recovery(store):
+    crash(store, "session.change_product_stock(1, 7)\nsession.commit()")
+    assert os.path.getsize(store + ".wal") > 0
+    assert stock(store, 1) == 7
+    # the session that recovered the log folded it into the shelve
+    assert not os.path.exists(store + ".wal")
+
+
+def test_wal_recovery_after_torn_record(store):
+    with open(store + ".wal", "wb") as log:
+        log.write(b"\x10\x00")
+    crash(store, "session.change_product_stock(1, 42)\nsession.commit()")
+    assert stock(store, 1) == 42
+
+
+def test_group_commit_deadline(store, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd) or fsync(fd))
+    with Hypergraph.HypergraphSession(
+        store, wal=True, group_commit_window=0.2
+    ) as session:
+        session.change_product_stock(1, 3)
+        session.commit()
+        synced.clear()
+        session.change_product_stock(1, 4)
+        session.commit()
+        assert synced == []
+        time.sleep(0.5)
+        assert synced
+
+
+@pytest.mark.parametrize("wal", [False, True])
+def test_transaction_rollback_on_invalid_foreign_key(store, wal):
+    with Hypergraph.HypergraphSession(store) as session:
+        cart = sorted(session.db["cart_item"])
+        orders = len(session.db["order"])
+    with pytest.raises(Exception, match="foreign key"):
+        with Hypergraph.transaction(store, wal) as session:
+            session.change_product_stock(2, 9)
+            session.add_item_to_cart(2, 2, 1)
+            session.place_order(2, [2])
+            session.add_item_to_cart(2, 42, 1)
+    with Hypergraph.HypergraphSession(store) as session:
+        assert session.db["product"][2]["stock"] == 5
+        assert sorted(session.db["cart_item"]) == cart
+        assert len(session.db["order"]) == orders
+
+
+def test_invalid_foreign_key_raises(store):
+    with Hypergraph.HypergraphSession(store) as session:
+        with pytest.raises(Exception, match="foreign key"):
+            session.add_product(
+                {"product_name": "p", "stock": 1, "price": 1, "supplier_id": 42}
+            )
+        assert session.get_product("p") == []
+
+
+def test_cascade_delete(store):
+    keys = Hypergraph.table_keys()
+    with Hypergraph.HypergraphSession(store) as session:
+        before = {t: len(session.db[t]) for t in keys}
+        counts = session.delete_customers([1, 42])
+    assert counts["customer"] == 1 and counts["order"] == 1
+    with Hypergraph.HypergraphSession(store) as session:
+        for t in keys:
+            assert before[t] - len(session.db[t]) == counts.get(t, 0)
+            # nothing references a deleted row, and the tombstones are not read as rows
+            parents = Hypergraph.get_foreign_key_list(t)
+            for pk in session.db[t]:
+                row = session.db[t][pk]
+                assert row is not None
+                for parent in parents:
+                    assert row[keys[parent]] in session.db[parent]
+        assert 1 not in session.db["customer"]
+        assert session.get_customer("user0") == []
+        assert session.get_orders(1) == []
+
+
+def test_order_totals_are_persisted(store, monkeypatch):
+    with Hypergraph.HypergraphSession(store) as session:
+        total = session.get_cost_of_order(1, 1, verify=True)
+    with monkeypatch.context() as patch:
+        patch.setattr(Hypergraph, "order_cost", None)
+        with Hypergraph.HypergraphSession(store) as session:
+            assert session.get_cost_of_order(1, 1) == total
+    # a price change made without reading the totals still updates the stored ones
+    with Hypergraph.HypergraphSession(store) as session:
+        Hypergraph.update(session.db, "product", 2, {"price": 10})
+    with Hypergraph.HypergraphSession(store) as session:
+        assert session.get_cost_of_order(1, 1, verify=True) > total
+
+
+def test_feedback_postings_are_persisted(store, monkeypatch):
+    with Hypergraph.HypergraphSession(store) as session:
+        keys = sorted(session.db["order_content"])
+        Hypergraph.update(
+            session.db, "order_content", keys[0], {"feedback": "Snug qwfit"}
+        )
+        Hypergraph.update(
+            session.db, "order_content", keys[1], {"feedback": "loose qwfit"}
+        )
+    with monkeypatch.context() as patch:
+        patch.setattr(Hypergraph.TextIndex, "build", None)
+        with Hypergraph.HypergraphSession(store) as session:
+            index = session.db["order_content"].text_indexes["feedback"]
+            assert index.search("qwfit") == set(keys[:2])
+            assert index.search("snug QWFIT") == {keys[0]}
+            assert index.search("snug loose", match_all=False) == set(keys[:2])
+            Hypergraph.update(
+                session.db, "order_content", keys[0], {"feedback": "zxok"}
+            )
+    with Hypergraph.HypergraphSession(store) as session:
+        index = session.db["order_content"].text_indexes["feedback"]
+        assert index.search("snug") == set()
+        assert index.search("qwfit") == {keys[1]}
+
+
+def test_price_index_is_persisted(store, monkeypatch):
+    monkeypatch.setattr(Hypergraph, "RANGE_CHUNK_SIZE", 1)
+    with Hypergraph.HypergraphSession(store) as session:
+        session.mass_insert_product([[f"extra{i}", 1, i % 4, 1] for i in range(9)])
+        Hypergraph.update(session.db, "product", 1, {"price": 7})
+        Hypergraph.delete(session.db, "product", 5)
+    with monkeypatch.context() as patch:
+        patch.setattr(Hypergraph.RangeIndex, "build", None)
+        with Hypergraph.HypergraphSession(store) as session:
+            products = session.db["product"]
+            expected = sorted(
+                (row["price"], pk) for pk, row in products.items() if row["price"] <= 2
+            )
+            assert products.range_indexes["price"].range(None, 2) == [
+                pk for _, pk in expected
+            ]
+            assert [p["productid"] for p in session.get_products_by_price(7)] == [1]